@@ -1,31 +1,110 @@
 import time
 import os
+import threading
 import datetime
-from dash import Dash, Input, Output, State, ctx, html, dcc, callback, set_props, no_update
+import uuid
+from dash import Dash, Input, Output, State, ctx, html, dcc, callback, clientside_callback, ClientsideFunction, set_props, no_update
+from flask import Response, stream_with_context, request, g
 from celery import Celery, worker
+import redis
 import dash_ag_grid as dag
-from icecream import ic
 import utils
+import backend
+import metrics
+import polling
+from clusters import Cluster, load_clusters
+from events import STATUS_RANK, stream_task_events, task_row
+from store import SQLiteTaskStore, TaskStoreWriter
+from grid_diff import GridDiff
+from progress import ProgressReporter
+from throughput import ThroughputStats, queue_depths
+from submission import PRIORITY_CLASSES, PRIORITY_TRANSPORT_OPTIONS, SubmissionQueue
 import dash_bootstrap_components as dbc
 
 REDIS_NUM = 1 if "workspace" in os.environ.get("DASH_REQUESTS_PATHNAME_PREFIX") else 3
 
+# the cluster of the tasks defined below (the celery workers are started with this app)
 celery_app = Celery(
     __name__,
     broker=f"{os.environ['REDIS_URL']}/{REDIS_NUM}",
     backend=f"{os.environ['REDIS_URL']}/{REDIS_NUM + 1}",
 )
-celery_inspector = celery_app.control.inspect()
+celery_app.conf.update(
+    # one list per priority in the broker, so the priority classes of the submissions are respected
+    broker_transport_options=PRIORITY_TRANSPORT_OPTIONS,
+    # every worker process reserves one task at a time: the rest stay in the broker, where the priorities apply
+    worker_prefetch_multiplier=1,
+)
+# the inspector snapshots are shared by all the gunicorn workers and sessions through redis
+# so N open tabs send one broadcast every INSPECTOR_CACHE_TTL seconds instead of N
+redis_client = redis.Redis.from_url(f"{os.environ['REDIS_URL']}/{REDIS_NUM + 1}")
+# /metrics shows the totals of all the gunicorn workers (see metrics.MetricsRegistry)
+metrics.share(redis_client, interval=float(os.environ.get("METRICS_FLUSH_INTERVAL", 10)))
+cluster_settings = dict(
+    # seconds each inspector broadcast waits for the workers' replies
+    inspector_timeout=float(os.environ.get("INSPECTOR_TIMEOUT", 1.0)),
+    cache_ttl=float(os.environ.get("INSPECTOR_CACHE_TTL", 5)),
+    cache_stale_ttl=float(os.environ.get("INSPECTOR_CACHE_STALE_TTL", 60)),
+)
+# the rest of the clusters shown in the grid come from CELERY_CLUSTERS (see clusters.load_clusters)
+# every cluster has its own connections, inspector and TaskEventTracker (an in-memory table of
+# task states fed by the celery event stream)
+clusters = load_clusters(
+    Cluster(os.environ.get("CELERY_CLUSTER_NAME", "default"), celery_app, redis_client, **cluster_settings),
+    redis_client,
+    os.environ.get("CELERY_CLUSTERS"),
+    **cluster_settings,
+)
+# seconds between the checks of check_task_status when the /task-events stream isn't connected (see polling.py)
+POLL_MIN_INTERVAL = float(os.environ.get("POLL_MIN_INTERVAL", 2))
+POLL_MAX_INTERVAL = float(os.environ.get("POLL_MAX_INTERVAL", 60))
+# seconds the checks wait for every cluster; the clusters that take longer are skipped until the next check
+CLUSTER_POLL_TIMEOUT = float(os.environ.get("CLUSTER_POLL_TIMEOUT", 10))
+# tasks shown in the grid (the grid asks for one page at a time, see get_grid_rows)
+# the history is kept in a sqlite file shared by all the gunicorn workers
+task_store = SQLiteTaskStore(
+    os.environ.get("TASK_STORE_PATH", "tasks.db"),
+    retention_days=float(os.environ.get("TASK_STORE_RETENTION_DAYS", 7)),
+    max_tasks=int(os.environ.get("TASK_STORE_MAX_TASKS", 100000)),
+)
+# the rows of the celery events are written in batches, off the event receiver threads
+task_store_writer = TaskStoreWriter(task_store)
+# rolling tasks/sec, queue wait and runtime by worker and task name (the throughput panel)
+throughput_stats = ThroughputStats(window=float(os.environ.get("THROUGHPUT_WINDOW", 300)))
+for cluster in clusters:
+    cluster.tracker.add_listener(lambda task_info: task_store_writer.add(task_row(task_info)))
+    cluster.tracker.add_listener(throughput_stats.observe)
+# last rows sent to every grid, so only what has changed is sent again (see push_transaction)
+grid_diff = GridDiff(redis_client)
+# results bigger than this (in bytes) aren't fetched by the callbacks, only their size and beginning;
+# the whole result is downloaded from /results/<task_id>
+RESULT_MAX_BYTES = int(os.environ.get("RESULT_MAX_BYTES", 64 * 1024))
+# tasks that can be sent with one click (task_count)
+MAX_TASKS_PER_CLICK = 1000
+# the clicks go through a queue in redis with dedup, per-user rate limits and priority classes
+# instead of straight to send_task (see submission.py); by default a user can send one click
+# of MAX_TASKS_PER_CLICK tasks at once, and 10 tasks per second after that
+submissions = SubmissionQueue(
+    celery_app,
+    redis_client,
+    rate=float(os.environ.get("SUBMISSION_RATE", 10.0)),
+    burst=int(os.environ.get("SUBMISSION_BURST", MAX_TASKS_PER_CLICK)),
+    max_count=MAX_TASKS_PER_CLICK,
+    dedup_ttl=float(os.environ.get("SUBMISSION_DEDUP_TTL", 300)),
+    max_queued=int(os.environ.get("SUBMISSION_MAX_QUEUED", 10)),
+)
 # CELERY_HOSTNAME = worker.worker.WorkController(app=celery_app).hostname
 
 app = Dash(update_title=None, external_stylesheets=[dbc.themes.BOOTSTRAP])
 server = app.server
 
 def layout():
+    clusters.start_trackers()
+    clusters.warm_connections(int(os.environ.get("CONTROL_WARM_THREADS", 4)))
+    submissions.start()
 
-    # populate the table with tasks that have been sent prior to the page load
-    initial_celery_data = utils.get_celery_status(celery_inspector)
-    ic(initial_celery_data)
+    # the grid gets its rows from the task_store (get_grid_rows), without waiting for celery
+    # the tasks sent prior to the page load are added by load_initial_tasks once the page is rendered
     return dbc.Container(
         [
             html.H2("Celery Monitor App"),
@@ -33,6 +112,18 @@ def layout():
             # components to trigger celery tasks
             html.H4("Tasks to test celery", style={"padding-top":"2px"}),
             utils.task_description,
+            html.Span("Number of tasks to send per click:"),
+            dcc.Input(id="task_count", type="number", min=1, max=MAX_TASKS_PER_CLICK, step=1, value=1, style={"margin":"2px"}),
+            html.Span("Priority:"),
+            dcc.Dropdown(
+                id="task_priority",
+                options=list(PRIORITY_CLASSES),
+                value="normal",
+                clearable=False,
+                style={"width":"120px", "display":"inline-block", "verticalAlign":"middle", "margin":"2px"},
+            ),
+            # result of the last submission (rate limited, duplicated...)
+            html.Div(id="submission_status"),
             dbc.Row([
                 dbc.Col(dbc.Card(dbc.CardBody([
                     dbc.Button(id="button_1", children="Run task 1! (2 min)", style={"margin":"2px"}),
@@ -47,9 +138,12 @@ def layout():
                 ))
             ], style={"margin-botton":"5px"}), 
             # table to display the task checks with interval to update it every minute
+            # its interval is set by check_task_status after every check (see polling.py)
             dcc.Interval(
-                id="interval", interval=1000 * 60, disabled=True
+                id="interval", interval=1000 * POLL_MIN_INTERVAL, disabled=True
             ),  
+            # current backoff of the interval, in seconds
+            dcc.Store(id="poll_state", data={"backoff": POLL_MIN_INTERVAL}),
             dbc.Button(
                 id="check_celery", children="Check celery status and update table", style={"margin":"2px"}
             ),
@@ -63,15 +157,31 @@ def layout():
                 inline=True,
             ),
             html.Div(id="check_celery_output"),
+            # triggers load_initial_tasks after the first render
+            dcc.Store(id="initial_load"),
+            # the /task-events stream (assets/task_events.js) writes the changed rows in push_updates
+            # and whether it's connected in push_connected
+            dcc.Store(id="push_updates"),
+            dcc.Store(id="push_connected", data=False),
+            dcc.Store(id="completed_tasks"),
+            # identifies the browser (it's kept in localStorage) to show only its tasks in the grid
+            dcc.Store(id="client_id", storage_type="local", data=str(uuid.uuid4())),
+            # rowTransaction-like changes for the grid, applied by assets/task_events.js:
+            # with the infinite row model the grid doesn't accept rowTransaction
+            dcc.Store(id="grid_transaction"),
+            # identifies the grid of this tab (a new one on every page load), for the grid_diff
+            dcc.Store(id="session_id", data=str(uuid.uuid4())),
+            # timestamp of the last changes sent to the grid
+            dcc.Store(id="grid_synced_at", data=time.time()),
             dag.AgGrid(
                 id="dag_celery",
-                rowData=initial_celery_data,
                 columnDefs=[
-                    {"field": c, "label": c}
+                    {"field": c, "label": c, "filter": "agTextColumnFilter"}
                     # fields from TASK_INFO: https://docs.celeryq.dev/en/latest/reference/celery.app.control.html#celery.app.control.Inspect.query_task
                     # you could add your own custom fields and updates, for example: "triggered_by", or "cancelled_at"
                     # "time_start" indicates the time the task was SENT to celery, not the time it actually started running
                     for c in [
+                        "cluster",
                         "id",
                         "name",
                         "args",
@@ -80,11 +190,63 @@ def layout():
                         "time_end",
                         "status",
                     ]
+                ] + [
+                    # reported by the tasks with progress.ProgressReporter
+                    {
+                        "field": "progress",
+                        "filter": "agNumberColumnFilter",
+                        "valueFormatter": {"function": "params.value == null ? '' : params.value + '%'"},
+                    },
+                    {"field": "progress_message", "headerName": "progress message", "filter": "agTextColumnFilter"},
+                    # the grid only gets the size and the beginning of the results (see backend.get_task_metas)
+                    {
+                        "field": "result_size",
+                        "headerName": "result size",
+                        "filter": "agNumberColumnFilter",
+                        "valueFormatter": {"function": "params.value == null ? '' : d3.format('.3~s')(params.value) + 'B'"},
+                    },
+                    {"field": "result_preview", "headerName": "result", "filter": "agTextColumnFilter"},
+                    {
+                        "headerName": "full result",
+                        "valueGetter": {"function": f"params.data && params.data.result_size ? '[download]({app.config.requests_pathname_prefix}results/' + params.data.id + ')' : ''"},
+                        "cellRenderer": "markdown",
+                        "linkTarget": "_blank",
+                    },
                 ],
                 getRowId="params.data.id",
-                dashGridOptions={"rowSelection": "single"},
+                # only the rows that are visible are requested to the server (get_grid_rows),
+                # filtered and sorted there
+                # https://dash.plotly.com/dash-ag-grid/infinite-row-model
+                rowModelType="infinite",
+                dashGridOptions={
+                    "rowSelection": "multiple",
+                    "cacheBlockSize": 100,
+                    "maxBlocksInCache": 10,
+                },
+            ),
+            dbc.Button(id="cancel_task", children="Cancel selected tasks", disabled=True),
+            # throughput of the workers and queues, from the celery events (see throughput.py)
+            html.H4("Throughput", style={"padding-top":"10px"}),
+            html.P(id="throughput_window"),
+            # disabled while nothing is running (see update_throughput)
+            dcc.Interval(id="throughput_interval", interval=1000 * 5),
+            dag.AgGrid(
+                id="throughput_grid",
+                columnDefs=[
+                    {"field": "scope"},
+                    {"field": "cluster"},
+                    {"field": "key", "headerName": "worker / task / queue"},
+                    {"field": "queue_depth", "headerName": "queue depth"},
+                    {"field": "tasks_per_sec", "headerName": "tasks/sec"},
+                    {"field": "completed"},
+                ] + [
+                    {"field": field, "headerName": field.replace("_", " ") + " (s)", "valueFormatter": {"function": "params.value == null ? '' : d3.format('.3~f')(params.value)"}}
+                    for field in ["wait_p50", "wait_p95", "runtime_p50", "runtime_p95"]
+                ],
+                rowData=[],
+                columnSize="responsiveSizeToFit",
+                dashGridOptions={"domLayout": "autoHeight"},
             ),
-            dbc.Button(id="cancel_task", children="Cancel selected task", disabled=True),
         ], style={"padding":"10px"}
     )
 
@@ -98,6 +260,13 @@ TASK_OUTPUTS = {
     "my_task_2": {"component_id": "paragraph_2", "component_prop": "children"},
 }
 
+# what is shown in the layout for the result of a task: the result itself
+# or a link to download it if it's too big (see RESULT_MAX_BYTES)
+def task_output(task_id, task_meta):
+    if task_meta.get("result_truncated"):
+        return html.A("Result too big to show, download it", href=f"{app.config.requests_pathname_prefix}results/{task_id}", target="_blank")
+    return task_meta["result"]
+
 # I've created two simple tasks
 @celery_app.task(name="my_task_1")
 def mytask1_wrapped(n_clicks):
@@ -108,29 +277,55 @@ def mytask1_wrapped(n_clicks):
     return f"task 1: Clicked {n_clicks} times completed at {datetime.datetime.now()}"
 
 
-@celery_app.task(name="my_task_2")
-def mytask2_wrapped(n_clicks, len_min):
-    # prints to check if the task keeps running after being cancelled
-    for i in range(len_min):
-        if i == 0 : 
-            print(f"my_task_2 started with expected duration of {len_min} min. Current time is: {datetime.datetime.now()}")
-        else : 
-            print(f"{i} min have passed at {datetime.datetime.now()}")
-        time.sleep(60)
+@celery_app.task(name="my_task_2", bind=True)
+def mytask2_wrapped(self, n_clicks, len_min):
+    # the progress is updated every second, but it's only written every few seconds (see ProgressReporter)
+    with ProgressReporter(self, min_interval=5) as progress:
+        # prints to check if the task keeps running after being cancelled
+        for i in range(len_min):
+            if i == 0 : 
+                print(f"my_task_2 started with expected duration of {len_min} min. Current time is: {datetime.datetime.now()}")
+            else : 
+                print(f"{i} min have passed at {datetime.datetime.now()}")
+            for second in range(60):
+                progress.update(100 * (i * 60 + second) / (len_min * 60), f"{i} of {len_min} min")
+                time.sleep(1)
 
     print(f"Finishing task 2 with n_clicks={n_clicks} and len={len_min}")
     return f"task 2: Clicked {n_clicks} times completed at {datetime.datetime.now()}"
 
 
+# adds the tasks that have been sent prior to the page load to the store
+# it runs after the layout has been rendered, so a slow celery cluster doesn't delay the page
+@callback(
+    Input("initial_load", "data"),
+    State("session_id", "data"),
+)
+@metrics.timed("callback.load_initial_tasks")
+def load_initial_tasks(_, session_id):
+    clusters.start_trackers()
+    # the snapshots of all the clusters at the same time; the ones that don't reply on time are skipped
+    snapshots = clusters.poll(lambda cluster: cluster.inspector_rows(), CLUSTER_POLL_TIMEOUT)
+    changed_rows = task_store.upsert_many(row for rows in snapshots.values() for row in rows or [])
+    push_transaction(session_id, add=changed_rows)
+
+    # no return statement
+
+
 # callback with no output for improved performance
 # https://dash.plotly.com/advanced-callbacks#callbacks-with-no-outputs
 @callback(
     Input("button_1", "n_clicks"),
     Input("button_2", "n_clicks"),
     State("task_2_len", "value"),
+    State("task_count", "value"),
+    State("task_priority", "value"),
+    State("client_id", "data"),
+    State("session_id", "data"),
     prevent_initial_call=True,
 )
-def update_clicks(n_clicks_1, n_clicks_2, len_min):
+@metrics.timed("callback.update_clicks")
+def update_clicks(n_clicks_1, n_clicks_2, len_min, task_count, priority, client_id, session_id):
     if ctx.triggered:
         k, v = list(ctx.triggered_prop_ids.items())[0]  # there will only be one item
 
@@ -149,191 +344,432 @@ def update_clicks(n_clicks_1, n_clicks_2, len_min):
             task_name = None
 
         if task_name:
-            task_id = celery_app.send_task(task_name, kwargs=task_kwargs)
-            task_id_str = str(task_id)
+            # the min/max of the input are only checked by the browser
+            task_count = min(max(int(task_count or 1), 1), MAX_TASKS_PER_CLICK)
+            # the tasks get their ids now and are sent to celery by the dispatcher of the submissions
+            task_ids, submission_status = submissions.submit(
+                client_id, task_name, task_kwargs, count=task_count, priority=priority or "normal"
+            )
+            set_props("submission_status", {"children": {
+                "submitted": f"{len(task_ids)} {task_name} tasks submitted",
+                "duplicate": f"{task_name} with {task_kwargs} has already been submitted",
+                "rate_limited": f"Too many tasks, try again later: {len(task_ids)} of {task_count} {task_name} tasks submitted",
+            }[submission_status]})
+            # the duplicates are already in the store
+            if submission_status == "duplicate":
+                return
             triggered_at = datetime.datetime.now()
-            # https://dash.plotly.com/dash-ag-grid/client-side#transaction-updates
-            newRows = [
+            newRows = task_store.upsert_many(
                 {
-                    "id": task_id_str,
+                    "id": str(task_id),
                     "name": task_name,
                     "kwargs": str(task_kwargs),
                     "time_start": triggered_at.strftime("%H:%M:%S"),
                     "time_end": None,
                     "status": "Queued",
+                    "submitted_by": client_id,
+                    "cluster": clusters.default.name,
                 }
-            ]
-            set_props("dag_celery", {"rowTransaction": {"add": newRows}})
+                for task_id in task_ids
+            )
+            push_transaction(session_id, add=newRows)
 
     # no return statement
 
 
+# sends the changes of these rows to the grid of the tab, in one transaction
+# only what the grid doesn't have yet is sent (see GridDiff)
+def push_transaction(session_id, add=(), update=(), remove=()):
+    row_transaction = grid_diff.transaction(session_id, add=add, update=update, remove=remove)
+    if row_transaction:
+        set_props("grid_transaction", {"data": row_transaction})
+    return row_transaction
+
+# latency histograms and counters of all the workers in the prometheus format (MONITOR_METRICS=0 disables them)
+@server.route(f"{app.config.routes_pathname_prefix}metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# time of the whole callback request (including the json (de)serialization done by Dash),
+# to compare with the time of the callback itself (callback.*)
+@server.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@server.after_request
+def observe_request_time(response):
+    if request.path.endswith("_dash-update-component") and "request_started" in g:
+        output = (request.get_json(silent=True) or {}).get("output", "")
+        metrics.observe(f"request.{output}", time.perf_counter() - g.request_started)
+    return response
+
+# whole result of a task (the meta stored in the result backend), streamed in chunks
+@server.route(f"{app.config.routes_pathname_prefix}results/<task_id>")
+@metrics.timed("route.results")
+def task_result(task_id):
+    cluster = clusters.get((task_store.get(task_id) or {}).get("cluster"))
+    chunks = backend.stream_task_result(cluster.celery_app, task_id)
+    if chunks is None:
+        return Response(f"No result for task {task_id}", status=404, mimetype="text/plain")
+    return Response(
+        stream_with_context(chunks),
+        mimetype=cluster.celery_app.backend.content_type,
+        headers={"Content-Disposition": f'attachment; filename="{task_id}.json"'},
+    )
+
+# server-sent events with the changes of the tasks, fed by the TaskEventTracker
+# the web server needs threaded workers (see Procfile): every open tab keeps one request thread busy,
+# so only TASK_EVENTS_MAX_STREAMS streams per process are served; the rest of the tabs get a 503
+# and fall back to the interval (assets/task_events.js tries again later), and the callbacks
+# always have threads left
+task_event_streams = threading.BoundedSemaphore(int(os.environ.get("TASK_EVENTS_MAX_STREAMS", 8)))
+
+@server.route(f"{app.config.routes_pathname_prefix}task-events")
+def task_events():
+    if not task_event_streams.acquire(blocking=False):
+        metrics.inc("task_event_streams_rejected")
+        return Response("Too many open streams", status=503, mimetype="text/plain", headers={"Retry-After": "60"})
+    clusters.start_trackers()
+    response = Response(
+        stream_with_context(stream_task_events([cluster.tracker for cluster in clusters])),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # also when the client disconnects before the stream has started
+    response.call_on_close(task_event_streams.release)
+    return response
+
+# opens the /task-events stream once the layout has been rendered
+clientside_callback(
+    ClientsideFunction(namespace="task_events", function_name="connect"),
+    Output("push_connected", "data"),
+    Input("initial_load", "data"),
+)
+
+# applies the pushed rows to the grid (new rows only if include_other_users)
+clientside_callback(
+    ClientsideFunction(namespace="task_events", function_name="apply_updates"),
+    Output("grid_transaction", "data"),
+    Output("completed_tasks", "data"),
+    Input("push_updates", "data"),
+    State("include_other_users", "value"),
+    prevent_initial_call=True,
+)
+
+# applies the changes sent by the server (or pushed) to the rows loaded in the grid
+clientside_callback(
+    ClientsideFunction(namespace="task_events", function_name="apply_transaction"),
+    Input("grid_transaction", "data"),
+    prevent_initial_call=True,
+)
+
+# the grid asks for the rows again when the filter by user changes
+clientside_callback(
+    ClientsideFunction(namespace="task_events", function_name="refresh_grid"),
+    Input("include_other_users", "value"),
+    prevent_initial_call=True,
+)
+
+# infinite row model datasource: one page of rows, filtered and sorted by the task_store
+@callback(
+    Output("dag_celery", "getRowsResponse"),
+    Input("dag_celery", "getRowsRequest"),
+    State("include_other_users", "value"),
+    State("client_id", "data"),
+    State("session_id", "data"),
+)
+@metrics.timed("callback.get_grid_rows")
+def get_grid_rows(request, include_other_users, client_id, session_id):
+    if not request:
+        return no_update
+    rows, row_count = task_store.query(
+        start=request["startRow"],
+        end=request["endRow"],
+        filter_model=request.get("filterModel"),
+        sort_model=request.get("sortModel"),
+        submitted_by=None if include_other_users else client_id,
+    )
+    grid_diff.record(session_id, rows)
+    return {"rowData": rows, "rowCount": row_count}
+
+# updates the layout with the output of the tasks completed through the /task-events stream
+@callback(
+    Input("completed_tasks", "data"),
+    State("session_id", "data"),
+    prevent_initial_call=True,
+)
+@metrics.timed("callback.show_task_outputs")
+def show_task_outputs(completed_tasks, session_id):
+    grouped_tasks = clusters.group(completed_tasks)
+    replies = clusters.poll(
+        lambda cluster: backend.get_task_metas(
+            cluster.celery_app, [t["id"] for t in grouped_tasks[cluster]], max_result_bytes=RESULT_MAX_BYTES
+        ),
+        CLUSTER_POLL_TIMEOUT,
+        clusters=grouped_tasks,
+    )
+    task_metas = {task_id: task_meta for metas in replies.values() for task_id, task_meta in (metas or {}).items()}
+    for task_dict in completed_tasks:
+        output_info = TASK_OUTPUTS.get(task_dict.get("name"))
+        if output_info and task_dict["id"] in task_metas and task_metas[task_dict["id"]]["status"] == "SUCCESS":
+            set_props(
+                output_info.get("component_id"),
+                {output_info.get("component_prop"): task_output(task_dict["id"], task_metas[task_dict["id"]])},
+            )
+    # the tasks completed through the stream don't have the size and preview of their results yet
+    updated_rows = task_store.upsert_many(
+        {"id": task_id, **backend.result_fields(task_meta)} for task_id, task_meta in task_metas.items()
+    )
+    push_transaction(session_id, update=updated_rows)
+
 # this updates the "disabled" property of the interval, making it start running or stop
 # other updates to the grid with the task info are done via set_props
 @callback(
     Output("interval", "disabled"),
-    Input("dag_celery", "rowData"),
+    Input("grid_transaction", "data"),
     Input("interval", "n_intervals"),
     Input("check_celery", "n_clicks"),
+    Input("push_connected", "data"),
     State("interval", "disabled"),
     State("include_other_users", "value"),
+    State("client_id", "data"),
+    State("grid_synced_at", "data"),
+    State("session_id", "data"),
+    State("poll_state", "data"),
     prevent_initial_call=True,
 )
-def check_task_status(current_tasks, _intervals, _check_celery, _disabled, include_other_users):
-    # if there are tasks and none of them is pending, stop interval
-    # all(...) will return true if current_tasks is empty too, that's why we add "if current_tasks and"
-    if current_tasks and all(
-        [task["status"] in ["Cancelled", "Complete"] for task in current_tasks]
-    ) and (ctx.triggered_id != "check_celery"):
+@metrics.timed("callback.check_task_status")
+def check_task_status(_transaction, _intervals, _check_celery, push_connected, _disabled, include_other_users, client_id, grid_synced_at, session_id, poll_state):
+    submitted_by = None if include_other_users else client_id
+    # tasks in the grid that haven't been cancelled or completed
+    pending_tasks = task_store.pending(submitted_by=submitted_by)
+    # if none of the tasks is pending, stop interval
+    if not pending_tasks and (ctx.triggered_id != "check_celery"):
         return True  # stop interval
-    elif ctx.triggered_id == "dag_celery":
-        # start interval when a record is added to the table if it isn't running yet
+    # while the /task-events stream is connected the grid is updated as soon as the tasks change,
+    # the interval is only a slow safety net (e.g. events lost or a cluster without events)
+    elif push_connected and ctx.triggered_id in ["grid_transaction", "push_connected"]:
+        if (poll_state or {}).get("backoff") != POLL_MAX_INTERVAL:
+            set_props("poll_state", {"data": {"backoff": POLL_MAX_INTERVAL}})
+            set_props("interval", {"interval": 1000 * POLL_MAX_INTERVAL})
+        return False if _disabled else no_update
+    elif ctx.triggered_id in ["grid_transaction", "push_connected"]:
+        # the grid has changed: check again soon
+        if (poll_state or {}).get("backoff") != POLL_MIN_INTERVAL:
+            set_props("poll_state", {"data": {"backoff": POLL_MIN_INTERVAL}})
+            set_props("interval", {"interval": 1000 * POLL_MIN_INTERVAL})
+        # start interval when a record is added to the table (or the stream disconnects) if it isn't running yet
         return False if _disabled else no_update
     # if it's the interval what triggers the callback, run the check for tasks' status
     elif ctx.triggered_id in ["interval", "check_celery"]:
-        if include_other_users: # possible values: [], [True]
-            active_and_reserved = utils.get_celery_status(celery_inspector)
-            in_table = [t["id"] for t in current_tasks]
-            new_tasks = []
-            for t in active_and_reserved:
-                if t["id"] in in_table:
-                    continue
-                else :
-                    new_tasks.append(t)
-                    current_tasks.append(t)
-               
-            # add them to the table too
-            if new_tasks:
-                set_props("dag_celery", {"rowTransaction": {"add": new_tasks}})
-
-        for task_dict in current_tasks:
-            # don't do anything with tasks that have already been cancelled or completed
-            if task_dict["status"] in ["Cancelled", "Complete"]:
-                # for checks
-                # task_id = task_dict["task_id"]
-                # res = celery_app.AsyncResult(task_id)
-                # ic(task_id, celery_inspector.query_task(task_id), res.status)
+        clusters.start_trackers()
+        synced_at = time.time()
+        # every cluster is checked in its own thread; the ones that don't reply on time are skipped
+        pending_by_cluster = clusters.group(pending_tasks)
+        replies = clusters.poll(
+            lambda cluster: poll_cluster(cluster, pending_by_cluster.get(cluster, []), include_other_users),
+            CLUSTER_POLL_TIMEOUT,
+        )
+        metrics.inc("ticks")
+
+        new_tasks = []
+        updated_rows = []
+        for cluster_name, reply in replies.items():
+            if reply is None:
+                metrics.inc("cluster_timeouts")
                 continue
-            # if task is Queued or Running
-            else:
+            cluster_new_tasks, cluster_pending_tasks, task_metas, task_statuses = reply
+            new_tasks += cluster_new_tasks
+            metrics.inc("tasks_scanned", len(cluster_pending_tasks))
+            for task_dict in cluster_pending_tasks:
+                # if task is Queued or Running
                 task_id = task_dict["id"]
-                res = celery_app.AsyncResult(task_id)
-                # ic(task_id, celery_inspector.query_task(task_id), res.status)
-                # double check in case of concurrent callbacks
-                if res.status == "REVOKED":
-                    if task_dict["status"] != "Cancelled":
-                        set_props(
-                            "dag_celery",
-                            {
-                                "rowTransaction": {
-                                    "update": [
-                                        utils.update_row_value(
-                                            task_dict, {"status": "Cancelled"}
-                                        )
-                                    ]
-                                }
-                            },
-                        )
-                    else :
-                        continue
-                # task finished
-                elif res.ready():
-                    # more info about disable_sync_subtasks: https://docs.celeryq.dev/en/latest/userguide/tasks.html#avoid-launching-synchronous-subtasks
-                    result = res.get(disable_sync_subtasks=False)
+                task_meta = task_metas[task_id]
+                task_status = task_statuses[task_id]
+                # the progress comes with the same task meta (see progress.py)
+                updated_values = {
+                    k: v for k, v in backend.task_progress(task_meta).items() if v is not None and task_dict.get(k) != v
+                }
+                # only update the grid if the status has moved forward (e.g. concurrent callbacks) or the progress has changed
+                # (only the changed fields: the store merges them into the stored row)
+                if task_status is None or STATUS_RANK[task_status] <= STATUS_RANK.get(task_dict["status"], -1):
+                    if updated_values:
+                        updated_rows.append({"id": task_id, **updated_values})
+                    continue
+                elif task_status == "Complete":
+                    # the result was already retrieved with the task meta, no need for res.get()
                     output_info = TASK_OUTPUTS.get(task_dict["name"])
-                    # this first set_props statement is only if there's an outpus in the layout
-                    set_props(
-                        output_info.get("component_id"),
-                        {output_info.get("component_prop"): result},
-                    )
-
-                    set_props(
-                        "dag_celery",
-                        {
-                            "rowTransaction": {
-                                "update": [
-                                    utils.update_row_value(
-                                        task_dict,
-                                        {
-                                            "status": "Complete",
-                                            "time_end": datetime.datetime.now().strftime(
-                                                "%H:%M:%S"
-                                            ),
-                                        },
-                                    )
-                                ]
-                            }
-                        },
-                    )
-                else:
-                    # task_state is one of: "active", "reserved"
-                    # it's different from res.status, which can be ACTIVE, REVOKED, PENDING
-                    queried_task = celery_inspector.query_task(task_id)
-                    ic(queried_task)
-                    task_state = [task_info[task_id][0] for task_info in queried_task.values() if task_info.get(task_id)][0]
-                    # task still queued
-                    if task_state == "reserved":
-                        continue
-                    # if task isn't queued, it's running (task_state = "active")
-                    # only update the grid if it hasn't been updated yet
-                    elif task_dict["status"] != "Running":
+                    # this first set_props statement is only if there's an output in the layout
+                    if output_info:
                         set_props(
-                            "dag_celery",
-                            {
-                                "rowTransaction": {
-                                    "update": [
-                                        utils.update_row_value(
-                                            task_dict, {"status": "Running"}
-                                        )
-                                    ]
-                                }
-                            },
+                            output_info.get("component_id"),
+                            {output_info.get("component_prop"): task_output(task_id, task_meta)},
                         )
-                    else:
-                        continue
+                updated_values["status"] = task_status
+                if task_status in ["Complete", "Failed"]:
+                    updated_values["time_end"] = datetime.datetime.now().strftime("%H:%M:%S")
+                    updated_values.update(backend.result_fields(task_meta))
+                updated_rows.append({"id": task_id, **updated_values})
+
+        task_store.upsert_many(updated_rows)
+        # a single transaction with all the changes since the last check
+        # (these ones, the ones from the TaskEventTracker, the ones made by other users and the compaction of the store)
+        # diffed against what the grid already has, so the rows that haven't changed aren't sent
+        row_transaction = push_transaction(
+            session_id,
+            add=new_tasks,
+            update=task_store.changed_since(grid_synced_at or 0, submitted_by=submitted_by),
+            remove=task_store.removed_since(grid_synced_at or 0),
+        )
+        metrics.inc("rows_updated", sum(len(rows) for rows in row_transaction.values()))
+        set_props("grid_synced_at", {"data": synced_at})
+
+        # the next check: sooner if something has changed or a task is expected to finish soon
+        backoff = polling.next_backoff(
+            (poll_state or {}).get("backoff"), bool(row_transaction), POLL_MIN_INTERVAL, POLL_MAX_INTERVAL
+        )
+        check_in = polling.next_check_in(backoff, expected_finish_times(pending_tasks), time.time(), POLL_MIN_INTERVAL)
+        if push_connected:
+            backoff = check_in = POLL_MAX_INTERVAL
+        set_props("poll_state", {"data": {"backoff": backoff}})
+        set_props("interval", {"interval": int(1000 * check_in)})
 
         return no_update
 
+# timestamps when the running tasks are expected to finish: when they started (from the TaskEventTracker)
+# plus the median runtime of the previous tasks with the same name (from the throughput_stats)
+def expected_finish_times(pending_tasks):
+    finish_times = []
+    for task_dict in pending_tasks:
+        cluster = clusters.get(task_dict.get("cluster"))
+        started_at = (cluster.tracker.get(task_dict["id"]) or {}).get("started_at")
+        runtime = throughput_stats.expected_runtime(cluster.name, task_dict.get("name"))
+        if started_at and runtime is not None:
+            finish_times.append(started_at + runtime)
+    return finish_times
+
+# status of the pending tasks of one cluster (it runs in the thread of the cluster, see ClusterRegistry.poll)
+# returns the tasks added to the store, the pending tasks, their task metas and their grid statuses
+def poll_cluster(cluster, pending_tasks, include_other_users):
+    new_tasks = []
+    if include_other_users: # possible values: [], [True]
+        new_tasks = task_store.upsert_many(cluster.inspector_rows())
+        # the pending tasks as they are after the snapshot (e.g. without the revoked ones)
+        pending_tasks = {t["id"]: t for t in pending_tasks}
+        pending_tasks.update({t["id"]: t for t in new_tasks})
+        pending_tasks = [t for t in pending_tasks.values() if t["status"] not in utils.FINAL_STATUSES]
+
+    # one (pipelined) round-trip to the result backend for all the pending tasks
+    # the big results aren't fetched, so the cost of the check doesn't depend on their size
+    task_metas = backend.get_task_metas(cluster.celery_app, [t["id"] for t in pending_tasks], max_result_bytes=RESULT_MAX_BYTES)
+    task_statuses = {}
+    unknown_task_ids = []
+    for task_dict in pending_tasks:
+        task_id = task_dict["id"]
+        task_status = backend.BACKEND_STATUS.get(task_metas[task_id]["status"])
+        # the backend only knows about started and finished tasks,
+        # for the rest, one dict lookup per task; we only ask celery about tasks
+        # the tracker hasn't seen (e.g. tasks sent before the tracker was started)
+        if task_status not in utils.FINAL_STATUSES:
+            tracked_task = cluster.tracker.get(task_id)
+            if tracked_task:
+                task_status = tracked_task["status"]
+            elif task_status is None:
+                unknown_task_ids.append(task_id)
+        task_statuses[task_id] = task_status
+    if unknown_task_ids:
+        task_statuses.update(query_task_statuses(cluster, unknown_task_ids))
+    return new_tasks, pending_tasks, task_metas, task_statuses
+
+# fallback for tasks that neither the result backend nor the TaskEventTracker know about
+# one query_task per worker with all its tasks (destination=), plus one broadcast for the tasks whose worker
+# isn't known yet, all of them at the same time: the broadcasts grow with the workers, not with the tasks
+# returns {task_id: grid status or None if no worker has the task}
+def query_task_statuses(cluster, task_ids):
+    task_ids_by_host = {}
+    for task_id in task_ids:
+        task_ids_by_host.setdefault(cluster.task_hosts.get(task_id), []).append(task_id)
+    replies = utils.inspect_concurrently(
+        {
+            hostname: lambda hostname=hostname, host_task_ids=host_task_ids: metrics.timed("inspector.query_task")(
+                cluster.inspect([hostname] if hostname else None).query_task
+            )(*host_task_ids)
+            for hostname, host_task_ids in task_ids_by_host.items()
+        },
+        utils.inspector_deadline(cluster.inspector),
+        executor=cluster.executor,
+    )
+    task_statuses = {task_id: None for task_id in task_ids}
+    for reply in replies.values():
+        for hostname, task_infos in (reply or {}).items():
+            # task_state is one of: "active", "reserved"
+            # it's different from res.status, which can be ACTIVE, REVOKED, PENDING
+            for task_id, (task_state, _task_info) in (task_infos or {}).items():
+                cluster.task_hosts.set(task_id, hostname)
+                # task still queued; if it isn't queued, it's running (task_state = "active")
+                task_statuses[task_id] = "Queued" if task_state == "reserved" else "Running"
+    # no worker has these tasks (yet), or not the one we asked: the next time all of them will be asked
+    for task_id, task_status in task_statuses.items():
+        if task_status is None:
+            cluster.task_hosts.discard(task_id)
+    return task_statuses
+
 @callback(
     Input("cancel_task", "n_clicks"),
     State("dag_celery", "selectedRows"),
+    State("session_id", "data"),
     prevent_initial_row=True,
 )
-def cancel_job(click, selectedRows):
-    task_dict = selectedRows[0]
-    celery_app.control.revoke(task_dict["id"], terminate=True)
-    set_props(
-        "dag_celery",
-        {
-            "rowTransaction": {
-                "update": [utils.update_row_value(task_dict, {"status": "Cancelled"})]
-            }
-        }
-    )
+@metrics.timed("callback.cancel_job")
+def cancel_job(click, selectedRows, session_id):
+    task_ids = [task_dict["id"] for task_dict in selectedRows or []]
+    if not task_ids:
+        return
+    # the tasks still waiting in the submission queue won't be sent (the revoke is sent anyway,
+    # in case the dispatcher had just taken them)
+    submissions.cancel(task_ids)
+    # one control message per cluster for all its selected tasks
+    for cluster, cluster_tasks in clusters.group(selectedRows).items():
+        with metrics.timer("broker.revoke"):
+            cluster.revoke([t["id"] for t in cluster_tasks], terminate=True)
+    updated_rows = task_store.upsert_many({"id": task_id, "status": "Cancelled"} for task_id in task_ids)
+    push_transaction(session_id, update=updated_rows)
 
-# callbacks for performing checks (it takes 3-10 seconds, depending on the amount of tasks)
+# callbacks for performing checks (it takes ~1 inspector timeout, the broadcasts are sent concurrently)
 @callback(
     Output("check_celery_output", "children"),
     Input("check_celery", "n_clicks"),
-    State("dag_celery", "rowData"),
+    State("include_other_users", "value"),
+    State("client_id", "data"),
     prevent_initial_call=True,
 )
-def celery_status(_, current_tasks):
-    task_queries = [
-        celery_inspector.query_task(task_dict["id"]) for task_dict in current_tasks
-    ]
-    text = f"""
+@metrics.timed("callback.celery_status")
+def celery_status(_, include_other_users, client_id):
+    current_tasks = task_store.pending(submitted_by=None if include_other_users else client_id)
+    grouped_tasks = clusters.group(current_tasks)
+    replies = clusters.poll(
+        lambda cluster: cluster_status(cluster, [t["id"] for t in grouped_tasks.get(cluster, [])]),
+        CLUSTER_POLL_TIMEOUT,
+    )
+    text = ""
+    for cluster_name, reply in replies.items():
+        task_queries, inspector_snapshot = reply or (None, {"active": None, "revoked": None, "reserved": None})
+        if len(replies) > 1:
+            text += f"""
+    # Cluster {cluster_name}
+    """
+        text += f"""
     **Active tasks:** 
     ```
-    {celery_inspector.active()}
+    {inspector_snapshot["active"]}
     ```
     **Revoked tasks:** 
     ```
-    {celery_inspector.revoked()}
+    {inspector_snapshot["revoked"]}
     ```
     **Reserved tasks:** 
     ```
-    {celery_inspector.reserved()}
+    {inspector_snapshot["reserved"]}
     ```
     ## Information by task_id
     ```
@@ -342,12 +778,71 @@ def celery_status(_, current_tasks):
     """
     return utils.celery_status_summary(text)
 
+# one query_task broadcast for all the pending tasks of the cluster, sent at the same time as the rest of the checks
+# (the workers don't know anything about finished tasks)
+# returns the replies to query_task and the inspector snapshot (None if they didn't arrive on time)
+def cluster_status(cluster, task_ids):
+    deadline = time.monotonic() + utils.inspector_deadline(cluster.inspector) + 1.0
+    task_queries = (
+        cluster.executor.submit(metrics.timed("inspector.query_task")(cluster.inspector.query_task), *task_ids)
+        if task_ids else None
+    )
+    # the snapshot sends its own broadcasts from the cluster's executor, so it's waited for in this (poll) thread:
+    # a thread of the executor waiting for other threads of the same executor could starve it
+    try:
+        inspector_snapshot = utils.get_cached_inspector_snapshot(cluster.inspector, cluster.cache, cluster.executor)
+    except Exception:
+        inspector_snapshot = None
+    try:
+        task_queries = task_queries.result(timeout=max(0, deadline - time.monotonic())) if task_queries else {}
+    except Exception:
+        task_queries = None
+    return task_queries, inspector_snapshot or {"active": None, "revoked": None, "reserved": None}
+
+# rolling aggregates of the throughput panel, with the depth of the queues of every cluster
+# (one passive queue_declare per queue, shared by all the sessions through the cluster's cache)
+@callback(
+    Output("throughput_grid", "rowData"),
+    Output("throughput_window", "children"),
+    Input("throughput_interval", "n_intervals"),
+)
+@metrics.timed("callback.throughput")
+def update_throughput(_):
+    clusters.start_trackers()
+    depths = clusters.poll(
+        lambda cluster: cluster.cache.get(
+            "queue_depths", lambda: cluster.connections.call(lambda connection: queue_depths(cluster.celery_app, connection))
+        ),
+        CLUSTER_POLL_TIMEOUT,
+    )
+    rows = [
+        {"scope": "queue", "cluster": cluster_name, "key": queue, "queue_depth": depth}
+        for cluster_name, cluster_depths in depths.items() for queue, depth in (cluster_depths or {}).items()
+    ]
+    stats_rows = throughput_stats.rows()
+    # nothing queued, running or finished in the window: the panel won't change until a task is sent,
+    # so the interval stops (task_events.enable_interval starts it again)
+    if not stats_rows and not any(row["queue_depth"] for row in rows) and not task_store.pending():
+        set_props("throughput_interval", {"disabled": True})
+    window = f"Tasks completed, queue wait (sent to started) and runtime (started to done) in the last {throughput_stats.window:.0f} seconds"
+    return rows + stats_rows, window
+
+# the throughput panel is updated again when the grid changes (tasks sent, pushed updates) or after a check
+clientside_callback(
+    ClientsideFunction(namespace="task_events", function_name="enable_interval"),
+    Output("throughput_interval", "disabled"),
+    Input("grid_transaction", "data"),
+    Input("check_celery", "n_clicks"),
+    prevent_initial_call=True,
+)
+
 # auxiliar callback to disable the cancel button if no row is selected
 @callback(
     Output("cancel_task", "disabled"),
     Input("dag_celery", "selectedRows"),
     prevent_initial_call=True
 )
+@metrics.timed("callback.disable_button")
 def disable_button(selectedRows):
     if selectedRows:
         return False
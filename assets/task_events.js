@@ -0,0 +1,94 @@
+// keep in sync with STATUS_RANK in events.py
+const TASK_STATUS_RANK = {Queued: 0, Running: 1, Complete: 2, Failed: 2, Cancelled: 2};
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    task_events: {
+        // opens the /task-events stream (server-sent events) once
+        // EventSource reconnects by itself when the server closes the stream, but not when the server
+        // refuses it (503: the process has too many open streams): then it's opened again after a minute
+        // and the grid is updated by the interval meanwhile
+        connect: function(_) {
+            if (!window.taskEventsSource) {
+                const config = JSON.parse(document.getElementById("_dash-config").textContent);
+                const source = new EventSource(config.requests_pathname_prefix + "task-events");
+                source.onopen = () => dash_clientside.set_props("push_connected", {data: true});
+                source.onerror = () => {
+                    dash_clientside.set_props("push_connected", {data: false});
+                    if (source.readyState === EventSource.CLOSED) {
+                        window.taskEventsSource = null;
+                        setTimeout(() => dash_clientside.task_events.connect(), 60 * 1000);
+                    }
+                };
+                source.onmessage = (e) => dash_clientside.set_props("push_updates", {data: JSON.parse(e.data)});
+                window.taskEventsSource = source;
+            }
+            return false;
+        },
+        // rows: list of (partial) rows sent by the server
+        // returns the grid_transaction and the completed tasks (for show_task_outputs)
+        apply_updates: function(rows, includeOtherUsers) {
+            const noUpdate = dash_clientside.no_update;
+            const api = dash_ag_grid.getApi("dag_celery");
+            if (!rows || !rows.length || !api) {
+                return [noUpdate, noUpdate];
+            }
+            const add = [];
+            const update = [];
+            const completed = [];
+            rows.forEach((row) => {
+                const node = api.getRowNode(row.id);
+                if (node && node.data) {
+                    // only update the grid if the status has moved forward
+                    // or a running task has reported some progress
+                    const currentRank = TASK_STATUS_RANK[node.data.status] ?? -1;
+                    const progressChanged = row.status === node.data.status && currentRank < 2 && (
+                        row.progress !== node.data.progress || row.progress_message !== node.data.progress_message
+                    );
+                    if (TASK_STATUS_RANK[row.status] > currentRank || progressChanged) {
+                        update.push(Object.assign({}, node.data, row));
+                        if (row.status === "Complete") {
+                            completed.push({id: row.id, name: node.data.name, cluster: node.data.cluster});
+                        }
+                    }
+                } else if (includeOtherUsers && includeOtherUsers.length) {
+                    add.push(row);
+                }
+            });
+            const transaction = {};
+            if (add.length) transaction.add = add;
+            if (update.length) transaction.update = update;
+            return [
+                Object.keys(transaction).length ? transaction : noUpdate,
+                completed.length ? completed : noUpdate,
+            ];
+        },
+        // transaction: {add: [rows], update: [rows], remove: [rows]}
+        // the infinite row model doesn't support transactions: the loaded rows are updated in place
+        // and the grid asks the server for its rows again when rows are added or removed
+        apply_transaction: function(transaction) {
+            const api = dash_ag_grid.getApi("dag_celery");
+            if (!transaction || !api) {
+                return;
+            }
+            (transaction.update || []).forEach((row) => {
+                const node = api.getRowNode(row.id);
+                if (node && node.data) {
+                    node.setData(Object.assign({}, node.data, row));
+                }
+            });
+            if ((transaction.add || []).length || (transaction.remove || []).length) {
+                api.refreshInfiniteCache();
+            }
+        },
+        // returns the `disabled` of an interval
+        enable_interval: function() {
+            return false;
+        },
+        refresh_grid: function(_) {
+            const api = dash_ag_grid.getApi("dag_celery");
+            if (api) {
+                api.refreshInfiniteCache();
+            }
+        },
+    },
+});
@@ -0,0 +1,165 @@
+import json
+import re
+
+from celery import states
+from celery.backends.base import BaseKeyValueStoreBackend
+from celery.backends.redis import RedisBackend
+import metrics
+from progress import PROGRESS
+
+# grid status for the task states stored in the result backend
+# PENDING is also what the backend returns for unknown task ids, so it doesn't tell us anything
+# https://docs.celeryq.dev/en/latest/reference/celery.states.html
+BACKEND_STATUS = {
+    states.REVOKED: "Cancelled",
+    states.SUCCESS: "Complete",
+    states.FAILURE: "Failed",
+    states.STARTED: "Running",
+    states.RETRY: "Queued",
+    PROGRESS: "Running",
+}
+
+
+# progress fields of the grid row for the task meta, {} if the task hasn't reported any (see progress.py)
+def task_progress(task_meta):
+    if task_meta["status"] == PROGRESS and isinstance(task_meta.get("result"), dict):
+        return {"progress": task_meta["result"].get("percent"), "progress_message": task_meta["result"].get("message")}
+    elif task_meta["status"] == states.SUCCESS:
+        return {"progress": 100.0}
+    return {}
+
+
+# characters of the result shown in the grid
+RESULT_PREVIEW_CHARS = 200
+# celery writes the status first in the stored meta (see Backend._get_result_meta),
+# so it can be read from the beginning of a result that is too big to fetch
+STATUS_PATTERN = re.compile(rb'"status":\s*"(\w+)"')
+RESULT_PATTERN = re.compile(rb'"result":\s*')
+
+
+# equivalent to calling celery_app.AsyncResult(task_id).status/.ready()/.get() for every task,
+# but with one MGET to the result backend instead of 2-3 GETs per task
+# returns {task_id: meta}, where meta has (at least) "status", "result" and "result_size" (bytes of the result,
+# as stored in the backend)
+# with max_result_bytes (redis only), the stored metas bigger than that aren't fetched whole: unless the result fits
+# in the first max_result_bytes (e.g. it's the traceback what is big), their meta has "result": None,
+# "result_truncated": True and "result_preview" (the beginning of the result); see stream_task_result
+# it takes two pipelined round-trips (STRLEN and GET/GETRANGE) instead of one
+@metrics.timed("backend.get_task_metas")
+def get_task_metas(celery_app, task_ids, max_result_bytes=None):
+    backend = celery_app.backend
+    task_ids = list(task_ids)
+    if not task_ids:
+        return {}
+    # redis (and the rest of key-value backends) implement mget
+    if not isinstance(backend, BaseKeyValueStoreBackend):
+        return {task_id: backend.get_task_meta(task_id) for task_id in task_ids}
+
+    keys = [backend.get_key_for_task(task_id) for task_id in task_ids]
+    if max_result_bytes is None or not isinstance(backend, RedisBackend):
+        values = backend.mget(keys)
+        sizes = [len(value) if value else 0 for value in values]
+    else:
+        values, sizes = get_capped_values(backend.client, keys, max_result_bytes)
+    task_metas = {}
+    for task_id, value, size in zip(task_ids, values, sizes):
+        if not value:
+            task_metas[task_id] = {"status": states.PENDING, "result": None, "result_size": 0}
+        elif len(value) < size:
+            task_metas[task_id] = truncated_meta(value, size)
+        else:
+            task_meta = backend.decode_result(value)
+            start, end = result_span(value)
+            # other serializers than json
+            if end is None:
+                end = start + len(json.dumps(task_meta.get("result"), default=str).encode())
+            task_metas[task_id] = {**task_meta, "result_size": end - start}
+    return task_metas
+
+
+# values of the keys, but only the first max_bytes of the bigger ones
+# returns the values and the size of every key
+def get_capped_values(redis_client, keys, max_bytes):
+    with redis_client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.strlen(key)
+        sizes = pipe.execute()
+    with redis_client.pipeline(transaction=False) as pipe:
+        for key, size in zip(keys, sizes):
+            if size > max_bytes:
+                pipe.getrange(key, 0, max_bytes - 1)
+            else:
+                pipe.get(key)
+        values = pipe.execute()
+    return values, sizes
+
+
+# where the result is in the stored (json) meta: (start, end) byte offsets, end is None if `value`
+# (e.g. the beginning of the meta) doesn't have the whole result or it isn't json
+def result_span(value):
+    result = RESULT_PATTERN.search(value)
+    if not result:
+        return 0, None
+    text = value[result.end():].decode(errors="replace")
+    try:
+        _, end = json.JSONDecoder().raw_decode(text)
+    except ValueError:
+        return result.end(), None
+    # e.g. a number cut in the middle
+    if text[end:].lstrip()[:1] not in (",", "}"):
+        return result.end(), None
+    return result.end(), result.end() + len(text[:end].encode())
+
+
+# meta from the beginning of a (json) meta that is too big to fetch
+def truncated_meta(value, size):
+    status = STATUS_PATTERN.search(value)
+    start, end = result_span(value)
+    task_meta = {
+        # the tasks that store big results have finished
+        "status": status.group(1).decode() if status else states.SUCCESS,
+        "result": None,
+    }
+    # the result is small, it's the rest of the meta what is big (e.g. the traceback)
+    # the result is the stored json (e.g. exceptions are dicts)
+    if end is not None:
+        return {**task_meta, "result": json.loads(value[start:end]), "result_size": end - start}
+    return {
+        **task_meta,
+        # what is stored from the result on: the result and the few fields after it (e.g. date_done)
+        "result_size": size - start,
+        "result_truncated": True,
+        "result_preview": value[start:start + RESULT_PREVIEW_CHARS].decode(errors="replace") if start else "",
+    }
+
+
+# size and preview fields of the grid row for the task meta, {} if the task hasn't finished
+def result_fields(task_meta):
+    if task_meta["status"] not in states.READY_STATES:
+        return {}
+    preview = task_meta.get("result_preview")
+    if preview is None:
+        preview = json.dumps(task_meta["result"], default=str)[:RESULT_PREVIEW_CHARS]
+    return {"result_size": task_meta.get("result_size"), "result_preview": preview}
+
+
+# chunks of the stored meta of the task (with the whole result), read with GETRANGE
+# so the web server never holds a big result in memory; None if the task has no result
+def stream_task_result(celery_app, task_id, chunk_size=64 * 1024):
+    backend = celery_app.backend
+    if not isinstance(backend, RedisBackend):
+        task_meta = backend.get_task_meta(task_id)
+        if task_meta["status"] not in states.READY_STATES:
+            return None
+        return iter([json.dumps(task_meta, default=str)])
+
+    key = backend.get_key_for_task(task_id)
+    size = backend.client.strlen(key)
+    if not size:
+        return None
+
+    def chunks():
+        for start in range(0, size, chunk_size):
+            yield backend.client.getrange(key, start, start + chunk_size - 1)
+
+    return chunks()
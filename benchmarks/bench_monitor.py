@@ -0,0 +1,206 @@
+# Benchmarks for the hot paths of the monitor: get_celery_status, check_task_status and celery_status.
+#
+# It doesn't need redis or celery workers: the result backend and the shared cache use fakeredis
+# and the inspector is replaced by a fake cluster of N workers with M active/reserved/revoked tasks.
+# For every number of tasks it reports the latency, the broker round-trips (inspector broadcasts),
+# the result backend round-trips (redis commands) and the size of the callback payload.
+#
+# Usage (from the root of the repository):
+#     pip install fakeredis
+#     python benchmarks/bench_monitor.py --tasks 10 100 1000 10000 --workers 2 --broadcast-latency 0.05
+import argparse
+import copy
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from contextvars import copy_context
+
+import fakeredis
+import redis
+from celery.backends.redis import RedisBackend
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class CountingRedis(fakeredis.FakeRedis):
+    # counts the commands sent to redis (a pipeline counts as one round-trip)
+    round_trips = 0
+
+    def execute_command(self, *args, **kwargs):
+        CountingRedis.round_trips += 1
+        return super().execute_command(*args, **kwargs)
+
+    # the commands of a pipeline don't go through execute_command: every execute() is one round-trip
+    def pipeline(self, *args, **kwargs):
+        pipe = super().pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counted_execute(*args, **kwargs):
+            CountingRedis.round_trips += 1
+            return execute(*args, **kwargs)
+
+        pipe.execute = counted_execute
+        return pipe
+
+
+class FakeInspector:
+    # replies like celery_app.control.inspect() for `workers` workers; every broadcast waits `latency` seconds
+    broadcasts = 0
+
+    def __init__(self, task_ids, workers=2, latency=0.0, timeout=1.0):
+        self.latency = latency
+        self.timeout = timeout
+        self.destination = None
+        self.replies = {f"celery@worker{w}": {"active": [], "reserved": [], "revoked": []} for w in range(workers)}
+        hostnames = list(self.replies)
+        for i, task_id in enumerate(task_ids):
+            hostname = hostnames[i % len(hostnames)]
+            # a third of the tasks are running, a third are queued and a third have been cancelled
+            task_type = ["active", "reserved", "revoked"][i % 3]
+            if task_type == "revoked":
+                self.replies[hostname]["revoked"].append(task_id)
+            else:
+                self.replies[hostname][task_type].append({
+                    "id": task_id, "name": "my_task_1", "args": [], "kwargs": {"n_clicks": i},
+                    "type": "my_task_1", "hostname": hostname,
+                    "time_start": time.time() if task_type == "active" else None,
+                    "acknowledged": task_type == "active", "worker_pid": None,
+                })
+
+    # like Cluster.inspect: only the workers of `destination` reply
+    def inspect(self, destination=None):
+        inspector = copy.copy(self)
+        inspector.destination = destination
+        return inspector
+
+    def _broadcast(self, reply):
+        FakeInspector.broadcasts += 1
+        time.sleep(self.latency)
+        if self.destination is not None:
+            reply = {h: r for h, r in reply.items() if h in self.destination}
+        return json.loads(json.dumps(reply))
+
+    def active(self):
+        return self._broadcast({h: r["active"] for h, r in self.replies.items()})
+
+    def reserved(self):
+        return self._broadcast({h: r["reserved"] for h, r in self.replies.items()})
+
+    def revoked(self):
+        return self._broadcast({h: r["revoked"] for h, r in self.replies.items()})
+
+    def query_task(self, *task_ids):
+        task_ids = set(task_ids)
+        return self._broadcast({
+            h: {t["id"]: [task_type, t] for task_type in ["active", "reserved"] for t in r[task_type] if t["id"] in task_ids}
+            for h, r in self.replies.items()
+        })
+
+
+def import_app(store_path):
+    os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
+    os.environ.setdefault("DASH_REQUESTS_PATHNAME_PREFIX", "/")
+    os.environ["TASK_STORE_PATH"] = store_path
+    server = fakeredis.FakeServer()
+    redis.Redis.from_url = classmethod(lambda cls, url, **kwargs: CountingRedis(server=server))
+    import app
+
+    app.clusters.default.tracker.start = lambda: None
+    # the result backend of a celery app is per thread (and the clusters are polled from other threads),
+    # so all of them get the same fake client
+    backend_client = CountingRedis(server=server)
+    RedisBackend.client = property(lambda self: backend_client)
+    return app
+
+
+# runs a Dash callback outside of a request, like the Dash docs suggest for unit tests
+# returns the output and the props updated with set_props
+def run_callback(callback, triggered_id, *args):
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict
+
+    def run():
+        updated_props = {}
+        context_value.set(AttributeDict(
+            triggered_inputs=[{"prop_id": f"{triggered_id}.n_clicks", "value": 1}],
+            updated_props=updated_props,
+        ))
+        return callback(*args), updated_props
+
+    return copy_context().run(run)
+
+
+def payload_bytes(output, updated_props):
+    return len(json.dumps([output, updated_props], default=str))
+
+
+def setup(app, n_tasks, workers, latency):
+    task_ids = [str(uuid.uuid4()) for _ in range(n_tasks)]
+    app.clusters.default.inspector = FakeInspector(task_ids, workers, latency)
+    app.clusters.default.inspect = app.clusters.default.inspector.inspect
+    app.clusters.default.task_hosts.hosts.clear()
+    # every check starts with an empty cache and a fresh store
+    app.redis_client.flushall()
+    app.task_store._db().execute("DELETE FROM tasks")
+    app.clusters.default.tracker.tasks.clear()
+    app.task_store.upsert_many(
+        {"id": task_id, "name": "my_task_1", "status": "Queued", "submitted_by": "bench"} for task_id in task_ids
+    )
+    # a tenth of the tasks have finished, another tenth are known by the TaskEventTracker
+    backend = app.celery_app.backend
+    for task_id in task_ids[::10]:
+        backend.store_result(task_id, "done", "SUCCESS")
+    for task_id in task_ids[1::10]:
+        app.clusters.default.tracker.tasks[task_id] = {"id": task_id, "status": "Running"}
+    # the grid has loaded the first page of rows
+    rows, _ = app.task_store.query(0, 100)
+    app.grid_diff.record("bench-session", rows)
+
+
+def measure(f):
+    FakeInspector.broadcasts = 0
+    CountingRedis.round_trips = 0
+    started = time.perf_counter()
+    result = f()
+    return time.perf_counter() - started, FakeInspector.broadcasts, CountingRedis.round_trips, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the hot paths of the monitor")
+    parser.add_argument("--tasks", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--broadcast-latency", type=float, default=0.0,
+                        help="seconds every fake inspector broadcast takes")
+    args = parser.parse_args()
+
+    app = import_app(os.path.join(tempfile.mkdtemp(), "bench_tasks.db"))
+    import utils
+
+    paths = {
+        "get_celery_status": lambda: (utils.get_celery_status(app.clusters.default.inspector), {}),
+        "check_task_status": lambda: run_callback(
+            app.check_task_status, "interval", 1, 1, None, False, False, [1], "bench", 0, "bench-session", None
+        ),
+        "celery_status": lambda: run_callback(app.celery_status, "check_celery", 1, [1], "bench"),
+    }
+    print(f"{'path':<20} {'tasks':>7} {'p50 ms':>10} {'max ms':>10} {'broadcasts':>11} {'redis cmds':>11} {'payload B':>11}")
+    for n_tasks in args.tasks:
+        for name, path in paths.items():
+            latencies = []
+            for _ in range(args.repeat):
+                setup(app, n_tasks, args.workers, args.broadcast_latency)
+                latency, broadcasts, round_trips, (output, updated_props) = measure(path)
+                latencies.append(latency)
+            print(
+                f"{name:<20} {n_tasks:>7} {statistics.median(latencies) * 1000:>10.1f} {max(latencies) * 1000:>10.1f}"
+                f" {broadcasts:>11} {round_trips:>11} {payload_bytes(output, updated_props):>11}"
+            )
+
+
+if __name__ == "__main__":
+    main()
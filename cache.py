@@ -0,0 +1,63 @@
+import json
+import threading
+import time
+
+
+class SharedCache:
+    # cache in redis, so it's shared by all the gunicorn workers and browser sessions
+    # - values are fresh for `ttl` seconds; after that they are still returned (stale-while-revalidate)
+    #   for up to `stale_ttl` seconds while one process refreshes them in the background
+    # - only one process refreshes a key at a time (single-flight), the rest keep using
+    #   the cached value or wait for the refreshed one
+    # values have to be json serializable
+
+    def __init__(self, redis_client, ttl=5, stale_ttl=60, lock_timeout=10, prefix="celery_monitor:cache:"):
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.lock_timeout = lock_timeout
+        self.prefix = prefix
+
+    def get(self, key, fetch):
+        entry = self._read(key)
+        if entry and time.time() - entry["fetched_at"] < self.ttl:
+            return entry["value"]
+        # stale value: return it and refresh it in the background (if nobody is refreshing it yet)
+        elif entry:
+            lock = self._lock(key)
+            if lock.acquire(blocking=False):
+                threading.Thread(target=self._refresh, args=(key, fetch, lock), daemon=True).start()
+            return entry["value"]
+        # nothing cached: one process fetches the value and the rest wait for it
+        lock = self._lock(key)
+        if lock.acquire(blocking=False):
+            return self._refresh(key, fetch, lock)
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(0.1)
+            entry = self._read(key)
+            if entry:
+                return entry["value"]
+        # the process refreshing the value took too long or died
+        return fetch()
+
+    def _read(self, key):
+        cached = self.redis_client.get(self.prefix + key)
+        return json.loads(cached) if cached else None
+
+    def _lock(self, key):
+        # thread_local=False: the lock can be released by the background refresh thread
+        return self.redis_client.lock(self.prefix + key + ":lock", timeout=self.lock_timeout, thread_local=False)
+
+    def _refresh(self, key, fetch, lock):
+        try:
+            value = fetch()
+            entry = {"fetched_at": time.time(), "value": value}
+            self.redis_client.set(self.prefix + key, json.dumps(entry, default=str), px=int(self.stale_ttl * 1000))
+            return value
+        finally:
+            try:
+                lock.release()
+            # the lock expired while fetching
+            except Exception:
+                pass
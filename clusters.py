@@ -0,0 +1,197 @@
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from celery import Celery
+
+import metrics
+import utils
+from cache import SharedCache
+from connections import ControlConnections, WarmInspect
+from events import TaskEventTracker
+
+# the workers (and send_task) have to publish events for the TaskEventTracker
+# (this only configures the celery app of the monitor: the workers of every cluster are also
+# told to send them with control.enable_events, see TaskEventTracker)
+# https://docs.celeryq.dev/en/latest/userguide/configuration.html#worker-send-task-events
+CELERY_CONF = {
+    "worker_send_task_events": True,
+    "task_send_sent_event": True,
+}
+
+# a broker or result backend that is down mustn't hang the calls for minutes
+# (by default the redis backend has no connect timeout)
+CONNECTION_TIMEOUTS = {
+    "broker_connection_timeout": 4,
+    "redis_socket_connect_timeout": 4,
+    "redis_socket_timeout": 10,
+}
+
+
+class TaskHostIndex:
+    # task id -> hostname of the worker that has the task, for the newest `max_tasks` tasks
+    # (from the hostname of the inspector replies and of the task events)
+
+    def __init__(self, max_tasks=10000):
+        self.max_tasks = max_tasks
+        self.hosts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set(self, task_id, hostname):
+        with self._lock:
+            self.hosts.pop(task_id, None)
+            self.hosts[task_id] = hostname
+            while len(self.hosts) > self.max_tasks:
+                self.hosts.popitem(last=False)
+
+    def get(self, task_id):
+        with self._lock:
+            return self.hosts.get(task_id)
+
+    def discard(self, task_id):
+        with self._lock:
+            self.hosts.pop(task_id, None)
+
+
+class Cluster:
+    # one celery cluster (broker + result backend) monitored by the app
+    # every cluster has its own celery app (and so its own pool of broker connections), warm connections
+    # for the control calls, inspector, TaskEventTracker and SharedCache for the inspector snapshots
+    # and its own threads for the inspector broadcasts (executor) and the polls (at most `max_polls`
+    # at a time, see ClusterRegistry.poll), so a cluster that is down only blocks its own threads
+
+    def __init__(self, name, celery_app, redis_client, inspector_timeout=1.0, cache_ttl=5, cache_stale_ttl=60,
+                 max_polls=4):
+        self.name = name
+        self.celery_app = celery_app
+        self.celery_app.conf.update(CELERY_CONF)
+        self.celery_app.conf.update(CONNECTION_TIMEOUTS)
+        # the snapshot of a poll sends its broadcasts from the same pool (see cluster_status)
+        self.executor = ThreadPoolExecutor(max_workers=12, thread_name_prefix=f"celery-{name}")
+        self.max_polls = max_polls
+        self.polls = threading.BoundedSemaphore(max_polls)
+        self.connections = ControlConnections(celery_app)
+        # timeout: seconds each inspector broadcast waits for the workers' replies
+        self.inspector_timeout = inspector_timeout
+        self.inspector = self.inspect()
+        self.tracker = TaskEventTracker(celery_app, cluster=name)
+        self.task_hosts = TaskHostIndex()
+        self.tracker.add_listener(
+            lambda task_info: self.task_hosts.set(task_info["id"], task_info["hostname"]) if task_info.get("hostname") else None
+        )
+        self.cache = SharedCache(
+            redis_client, ttl=cache_ttl, stale_ttl=cache_stale_ttl, prefix=f"celery_monitor:cache:{name}:"
+        )
+
+    # inspector for some workers only (destination: list of hostnames); it returns as soon as all of them reply
+    def inspect(self, destination=None):
+        return WarmInspect(self.connections, timeout=self.inspector_timeout, destination=destination)
+
+    # one control message for all the tasks
+    def revoke(self, task_ids, **kwargs):
+        return self.connections.call(
+            lambda connection: self.celery_app.control.revoke(task_ids, connection=connection, **kwargs)
+        )
+
+    # grid rows of the active, reserved and revoked tasks of the cluster (from the cached inspector snapshot)
+    def inspector_rows(self):
+        rows = [
+            {**row, "cluster": self.name}
+            for row in utils.get_celery_status(self.inspector, cache=self.cache, executor=self.executor)
+        ]
+        for row in rows:
+            if row.get("hostname"):
+                self.task_hosts.set(row["id"], row["hostname"])
+        return rows
+
+
+class ClusterRegistry:
+    # the clusters by name; the default one is the cluster of the tasks sent by this app
+    # (and of the rows stored before there were several clusters)
+
+    def __init__(self, default):
+        self.default = default
+        self.clusters = {default.name: default}
+        self._warmed = False
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def add(self, cluster):
+        self.clusters[cluster.name] = cluster
+
+    def get(self, name):
+        return self.clusters.get(name) or self.default
+
+    def __iter__(self):
+        return iter(self.clusters.values())
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def start_trackers(self):
+        for cluster in self:
+            cluster.tracker.start()
+
+    # opens the control connections of `threads` inspector threads of every cluster in the background,
+    # once per process, so the first checks don't wait for them
+    def warm_connections(self, threads=4):
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+        for cluster in self:
+            cluster.connections.warm(cluster.executor, threads)
+
+    # {cluster: [rows]} for rows with a "cluster" field
+    def group(self, rows):
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(self.get(row.get("cluster")), []).append(row)
+        return grouped
+
+    # runs poll(cluster) for every cluster at the same time and waits for them for `deadline` seconds in total
+    # returns {cluster name: result}; the result is None for the clusters that failed or didn't reply on time
+    # the polls that don't reply on time keep running: a cluster that already has `max_polls` polls running
+    # isn't polled again until one of them finishes, so a cluster that is down can't take all the threads
+    def poll(self, poll, deadline, clusters=None):
+        clusters = list(clusters or self)
+        executor = self._poll_executor()
+        futures = {}
+        for cluster in clusters:
+            if not cluster.polls.acquire(blocking=False):
+                metrics.inc("cluster_polls_skipped")
+                continue
+            futures[cluster.name] = executor.submit(poll, cluster)
+            futures[cluster.name].add_done_callback(lambda _, cluster=cluster: cluster.polls.release())
+        done, _ = wait(futures.values(), timeout=deadline)
+        return {
+            cluster.name: futures[cluster.name].result()
+            if futures.get(cluster.name) in done and not futures[cluster.name].exception() else None
+            for cluster in clusters
+        }
+
+    # every cluster is polled in its own thread; there are threads for all the polls of all the clusters
+    def _poll_executor(self):
+        with self._lock:
+            max_workers = sum(cluster.max_polls for cluster in self)
+            if self._executor is None or self._executor._max_workers < max_workers:
+                # a cluster has been added: the polls that are running finish in the old one
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="celery-cluster")
+            return self._executor
+
+
+# config: json with the rest of the clusters to monitor (e.g. the CELERY_CLUSTERS env var):
+#     {"name": {"broker": "redis://...", "backend": "redis://...", "inspector_timeout": 1.0}}
+def load_clusters(default, redis_client, config=None, **cluster_kwargs):
+    registry = ClusterRegistry(default)
+    for name, cluster_config in json.loads(config or "{}").items():
+        cluster_config = dict(cluster_config)
+        # set_as_current=False: the current app is still the one of the tasks of this app
+        celery_app = Celery(
+            name, broker=cluster_config.pop("broker"), backend=cluster_config.pop("backend", None), set_as_current=False
+        )
+        registry.add(Cluster(name, celery_app, redis_client, **{**cluster_kwargs, **cluster_config}))
+    return registry
@@ -0,0 +1,102 @@
+import threading
+import time
+
+from celery.app.control import Inspect
+
+import metrics
+
+
+class ControlConnections:
+    # warm broker connections for the control calls (inspector broadcasts and revoke), one per thread:
+    # kombu connections aren't thread safe, and the replies of the broadcasts go to a reply queue
+    # per thread anyway (Mailbox.oid); the threads that send them are long-lived
+    # (the executors of the cluster and of ClusterRegistry.poll, and the gunicorn threads)
+    # - a connection that hasn't been used for `health_check_interval` seconds is checked before using it
+    # - broken connections are replaced on the next call (lazy reconnect)
+
+    def __init__(self, celery_app, health_check_interval=30):
+        self.celery_app = celery_app
+        self.health_check_interval = health_check_interval
+        self._local = threading.local()
+
+    def get(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and time.monotonic() - self._local.used_at > self.health_check_interval:
+            if not self._healthy(connection):
+                metrics.inc("broker_reconnects")
+                self.discard()
+                connection = None
+        if connection is None:
+            with metrics.timer("broker.connect"):
+                connection = self.celery_app.connection_for_write()
+                connection.ensure_connection(max_retries=1)
+            self._local.connection = connection
+        self._local.used_at = time.monotonic()
+        return connection
+
+    def discard(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            # closes it without waiting for the broker
+            connection.collect()
+
+    # calls f(connection) with the connection of the thread; if the connection turns out to be broken,
+    # it's replaced and f is called once more
+    def call(self, f):
+        connection = self.get()
+        try:
+            return f(connection)
+        except connection.recoverable_connection_errors:
+            metrics.inc("broker_reconnects")
+            self.discard()
+            return f(self.get())
+
+    # opens the connections of `threads` threads of the executor in the background
+    # (the barrier keeps every thread busy until all of them have one, so they are different threads)
+    def warm(self, executor, threads):
+        barrier = threading.Barrier(threads)
+
+        def warm_thread():
+            try:
+                self.get()
+                barrier.wait(timeout=10)
+            # the broker is down or slow: the connections will be opened when they're needed
+            except Exception:
+                barrier.abort()
+
+        for _ in range(threads):
+            executor.submit(warm_thread)
+
+    def _healthy(self, connection):
+        try:
+            if not connection.connected:
+                return False
+            # redis connections are always "connected" for kombu, the server has to be asked
+            client = getattr(connection.default_channel, "client", None)
+            if client is not None:
+                client.ping()
+            return True
+        except Exception:
+            return False
+
+
+class WarmInspect(Inspect):
+    # celery_app.control.inspect() that sends every broadcast with the warm connection of the thread
+    # so it can be shared by all the threads (the connection isn't chosen until the broadcast is sent)
+
+    def __init__(self, connections, **kwargs):
+        super().__init__(app=connections.celery_app, **kwargs)
+        self.connections = connections
+
+    def _request(self, command, **kwargs):
+        return self.connections.call(lambda connection: self._prepare(self.app.control.broadcast(
+            command,
+            arguments=kwargs,
+            destination=self.destination,
+            callback=self.callback,
+            connection=connection,
+            limit=self.limit,
+            timeout=self.timeout, reply=True,
+            pattern=self.pattern, matcher=self.matcher,
+        )))
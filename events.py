@@ -0,0 +1,195 @@
+import datetime
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from progress import PROGRESS_EVENT
+
+# grid status for every celery task event we listen to
+# https://docs.celeryq.dev/en/latest/userguide/monitoring.html#task-events
+EVENT_STATUS = {
+    "task-sent": "Queued",
+    "task-received": "Queued",
+    "task-retried": "Queued",
+    "task-started": "Running",
+    # sent by progress.ProgressReporter
+    PROGRESS_EVENT: "Running",
+    "task-succeeded": "Complete",
+    "task-failed": "Failed",
+    "task-revoked": "Cancelled",
+}
+
+# events can arrive out of order (e.g. task-sent is published by the web process
+# and task-started by the worker), so a task never goes back to an earlier status
+STATUS_RANK = {"Queued": 0, "Running": 1, "Complete": 2, "Failed": 2, "Cancelled": 2}
+
+
+class TaskEventTracker:
+    # keeps an in-memory table {task_id: task_info} up to date by consuming the celery
+    # event stream in a background thread, so checking the status of a task
+    # is a dict lookup instead of a broker/backend round-trip
+    # it requires the workers to send events: besides worker_send_task_events=True (or -E), they're told to
+    # (control.enable_events) every time it connects and when a worker comes online
+
+    def __init__(self, celery_app, max_tasks=10000, reconnect_delay=5, cluster=None):
+        self.celery_app = celery_app
+        # name of the cluster (see clusters.py), added to every task
+        self.cluster = cluster
+        self.max_tasks = max_tasks
+        self.reconnect_delay = reconnect_delay
+        self.tasks = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        # one queue per open /task-events stream
+        self._subscribers = []
+        # functions called with the task info every time a task changes
+        self._listeners = []
+
+    # the thread is started lazily (from the Dash callbacks) and not when app.py is imported,
+    # because the celery worker imports app.py too and doesn't need it
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="celery-event-tracker", daemon=True
+            )
+            self._thread.start()
+
+    def get(self, task_id):
+        with self._lock:
+            task_info = self.tasks.get(task_id)
+            return task_info.copy() if task_info else None
+
+    # the queue receives a copy of the task info every time a task changes
+    # the same queue can be subscribed to several trackers
+    def subscribe(self, subscriber=None):
+        subscriber = subscriber or queue.Queue(maxsize=self.max_tasks)
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def _run(self):
+        handlers = {event_type: self._on_event for event_type in EVENT_STATUS}
+        # worker events are sent even if task events aren't
+        handlers["worker-online"] = self._on_worker_online
+        while True:
+            try:
+                with self.celery_app.connection() as connection:
+                    receiver = self.celery_app.events.Receiver(connection, handlers=handlers)
+                    self.celery_app.control.enable_events()
+                    receiver.capture(limit=None, timeout=None, wakeup=True)
+            except Exception as e:
+                # ic is not thread-friendly
+                print(f"Celery event tracker disconnected ({e}), reconnecting in {self.reconnect_delay}s")
+            time.sleep(self.reconnect_delay)
+
+    # a worker started (or restarted) without task events
+    def _on_worker_online(self, event):
+        try:
+            self.celery_app.control.enable_events(destination=[event["hostname"]])
+        except Exception as e:
+            print(f"Celery event tracker couldn't enable the events of {event.get('hostname')} ({e})")
+
+    def _on_event(self, event):
+        task_id = event.get("uuid")
+        status = EVENT_STATUS.get(event.get("type"))
+        if not task_id or not status:
+            return
+        with self._lock:
+            task_info = self.tasks.pop(task_id, None) or {"id": task_id, "cluster": self.cluster}
+            if STATUS_RANK[status] >= STATUS_RANK.get(task_info.get("status"), -1):
+                task_info["status"] = status
+            # only task-sent and task-received include the name and kwargs
+            for k in ["name", "args", "kwargs"]:
+                if event.get(k) is not None:
+                    task_info[k] = event[k]
+            # a late progress event doesn't change a finished task
+            if event.get("type") == PROGRESS_EVENT and task_info["status"] == status:
+                task_info["progress"] = event.get("percent")
+                task_info["progress_message"] = event.get("message")
+            elif event.get("type") == "task-succeeded":
+                task_info["progress"] = 100.0
+            if event.get("type") in ["task-received", "task-started"]:
+                task_info["hostname"] = event.get("hostname")
+            task_info["timestamp"] = event.get("timestamp")
+            task_info["last_event"] = event.get("type")
+            if status == "Queued":
+                task_info.setdefault("sent_at", event.get("timestamp"))
+            elif event.get("type") == "task-started":
+                task_info["started_at"] = event.get("timestamp")
+            elif status == "Running":
+                task_info.setdefault("started_at", event.get("timestamp"))
+            else:
+                task_info["done_at"] = event.get("timestamp")
+            # most recently updated tasks are at the end
+            self.tasks[task_id] = task_info
+            while len(self.tasks) > self.max_tasks:
+                self.tasks.popitem(last=False)
+            for subscriber in self._subscribers:
+                try:
+                    subscriber.put_nowait(task_info.copy())
+                # nobody is reading this stream
+                except queue.Full:
+                    pass
+            task_info = task_info.copy()
+        for listener in self._listeners:
+            listener(task_info)
+
+
+# grid row (only the fields we know) from the task info of the TaskEventTracker
+def task_row(task_info):
+    row = {"id": task_info["id"], "status": task_info["status"]}
+    for k in ["name", "args", "kwargs", "progress", "progress_message", "cluster"]:
+        if task_info.get(k) is not None:
+            row[k] = task_info[k]
+    if task_info.get("sent_at"):
+        row["time_start"] = datetime.datetime.fromtimestamp(task_info["sent_at"]).strftime("%H:%M:%S")
+    if task_info.get("done_at") and task_info["status"] != "Cancelled":
+        row["time_end"] = datetime.datetime.fromtimestamp(task_info["done_at"]).strftime("%H:%M:%S")
+    return row
+
+
+# server-sent events with the rows of the tasks that change, as they change
+# all the changes that arrive together are coalesced into one message (a json list of rows)
+# the stream ends after max_duration seconds so the web server threads are recycled;
+# EventSource reconnects by itself
+# https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events
+# trackers: one or more TaskEventTracker (e.g. one per cluster), merged into one stream
+def stream_task_events(trackers, max_duration=300, keepalive=15):
+    trackers = trackers if isinstance(trackers, (list, tuple)) else [trackers]
+    subscriber = queue.Queue(maxsize=sum(tracker.max_tasks for tracker in trackers))
+    for tracker in trackers:
+        tracker.subscribe(subscriber)
+    try:
+        # ask the browser to wait 1 second before reconnecting
+        yield "retry: 1000\n\n"
+        end = time.time() + max_duration
+        while time.time() < end:
+            try:
+                task_info = subscriber.get(timeout=keepalive)
+            except queue.Empty:
+                # comment line, so proxies don't close the idle connection
+                yield ": keep-alive\n\n"
+                continue
+            rows = {task_info["id"]: task_row(task_info)}
+            while True:
+                try:
+                    task_info = subscriber.get_nowait()
+                except queue.Empty:
+                    break
+                rows[task_info["id"]] = task_row(task_info)
+            yield f"data: {json.dumps(list(rows.values()), default=str)}\n\n"
+    finally:
+        for tracker in trackers:
+            tracker.unsubscribe(subscriber)
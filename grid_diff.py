@@ -0,0 +1,73 @@
+import json
+
+import metrics
+
+
+class GridDiff:
+    # last state of the rows sent to every grid (one per browser tab: `session_id`), kept in redis
+    # so all the gunicorn workers share it; it turns the rows that may have changed into the minimal
+    # transaction for that grid:
+    # - add: ids of the new rows the grid hasn't seen yet (the infinite row model asks for the rows again,
+    #   see assets/task_events.js, so there's no need to send the whole rows)
+    # - update: only the fields that have changed, for the rows the grid has loaded
+    #   (the rest will be up to date when the grid asks for them, see record)
+    # - remove: rows the grid has loaded that aren't in the store anymore
+    # unchanged rows aren't sent at all
+
+    def __init__(self, redis_client, ttl=24 * 3600, prefix="celery_monitor:grid:"):
+        self.redis_client = redis_client
+        # state of the tabs that haven't been used for `ttl` seconds is dropped
+        self.ttl = ttl
+        self.prefix = prefix
+
+    # rows sent to the grid outside of a transaction (getRowsResponse)
+    @metrics.timed("grid_diff.record")
+    def record(self, session_id, rows):
+        rows = {row["id"]: json.dumps(row, default=str) for row in rows}
+        if not session_id or not rows:
+            return
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(self.prefix + session_id, mapping=rows)
+            pipe.expire(self.prefix + session_id, int(self.ttl))
+            pipe.execute()
+
+    # returns the transaction ({} if there's nothing to change) and records it as sent
+    # rows in `add` and `update` can be partial (they always have the id)
+    @metrics.timed("grid_diff.transaction")
+    def transaction(self, session_id, add=(), update=(), remove=()):
+        rows = {row["id"]: row for row in update}
+        rows.update({row["id"]: row for row in add})
+        added_ids = {row["id"] for row in add}
+        remove = [task_id for task_id in remove if task_id not in rows]
+        if not session_id or not (rows or remove):
+            return {}
+        key = self.prefix + session_id
+        task_ids = list(rows) + remove
+        sent = dict(zip(task_ids, self.redis_client.hmget(key, task_ids)))
+
+        transaction = {"add": [], "update": [], "remove": []}
+        changed_state = {}
+        for task_id, row in rows.items():
+            sent_row = json.loads(sent[task_id]) if sent[task_id] else None
+            if sent_row is None:
+                if task_id in added_ids:
+                    transaction["add"].append({"id": task_id})
+                    changed_state[task_id] = row
+                continue
+            changes = {k: v for k, v in row.items() if sent_row.get(k) != v}
+            if changes:
+                transaction["update"].append({"id": task_id, **changes})
+                changed_state[task_id] = {**sent_row, **changes}
+        removed_ids = [task_id for task_id in remove if sent[task_id]]
+        transaction["remove"] = [{"id": task_id} for task_id in removed_ids]
+        metrics.inc("rows_unchanged", len(rows) - len(changed_state))
+
+        if changed_state or removed_ids:
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                if changed_state:
+                    pipe.hset(key, mapping={k: json.dumps(v, default=str) for k, v in changed_state.items()})
+                if removed_ids:
+                    pipe.hdel(key, *removed_ids)
+                pipe.expire(key, int(self.ttl))
+                pipe.execute()
+        return {k: v for k, v in transaction.items() if v}
@@ -0,0 +1,228 @@
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+# latency buckets in seconds (inspector broadcasts wait ~1s for replies)
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    # latency histograms by operation and counters, in the prometheus text format
+    # https://prometheus.io/docs/instrumenting/exposition_formats/
+    # every gunicorn worker records its own; with share(redis_client) they are added up in redis
+    # (every worker flushes what it has recorded every `interval` seconds), so /metrics shows the
+    # totals of all the workers whichever answers the request; without it, it shows the worker that
+    # answers (the `pid` label tells them apart)
+
+    def __init__(self, prefix="celery_monitor"):
+        self.prefix = prefix
+        self.histograms = defaultdict(Histogram)
+        self.counters = defaultdict(float)
+        self.redis_client = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def observe(self, operation, seconds):
+        with self._lock:
+            self.histograms[operation].observe(seconds)
+
+    def inc(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def timer(self, operation):
+        return Timer(self, operation)
+
+    def share(self, redis_client, interval=10):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.redis_client = redis_client
+            self._thread = threading.Thread(target=self._flush_every, args=(interval,), name="metrics-flush", daemon=True)
+        self._thread.start()
+
+    # adds what this process has recorded since the last flush to the totals in redis
+    def flush(self):
+        with self._lock:
+            histograms, self.histograms = self.histograms, defaultdict(Histogram)
+            counters, self.counters = self.counters, defaultdict(float)
+        if not (histograms or counters):
+            return
+        try:
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                for operation, histogram in histograms.items():
+                    for i, count in enumerate(histogram.counts):
+                        if count:
+                            pipe.hincrby(f"{self.prefix}:metrics:histograms", f"{operation}|{i}", count)
+                    pipe.hincrbyfloat(f"{self.prefix}:metrics:histograms", f"{operation}|sum", histogram.sum)
+                    pipe.hincrby(f"{self.prefix}:metrics:histograms", f"{operation}|count", histogram.count)
+                for counter, value in counters.items():
+                    pipe.hincrbyfloat(f"{self.prefix}:metrics:counters", counter, value)
+                pipe.execute()
+        # redis isn't available: they are kept for the next flush
+        except Exception:
+            with self._lock:
+                for operation, histogram in histograms.items():
+                    kept = self.histograms[operation]
+                    kept.counts = [a + b for a, b in zip(kept.counts, histogram.counts)]
+                    kept.sum += histogram.sum
+                    kept.count += histogram.count
+                for counter, value in counters.items():
+                    self.counters[counter] += value
+            raise
+
+    def render(self):
+        if self.redis_client is not None:
+            try:
+                return self._render_shared()
+            # redis isn't available: what this process has recorded since the last flush
+            except Exception:
+                pass
+        with self._lock:
+            return self._render(self.histograms, self.counters, f'pid="{os.getpid()}"')
+
+    def _render_shared(self):
+        self.flush()
+        histograms = defaultdict(Histogram)
+        for field, value in self.redis_client.hgetall(f"{self.prefix}:metrics:histograms").items():
+            operation, _, bucket = (field.decode() if isinstance(field, bytes) else field).rpartition("|")
+            if bucket == "sum":
+                histograms[operation].sum = float(value)
+            elif bucket == "count":
+                histograms[operation].count = int(value)
+            else:
+                histograms[operation].counts[int(bucket)] = int(value)
+        counters = {
+            (counter.decode() if isinstance(counter, bytes) else counter): float(value)
+            for counter, value in self.redis_client.hgetall(f"{self.prefix}:metrics:counters").items()
+        }
+        return self._render(histograms, counters)
+
+    def _render(self, histograms, counters, labels=""):
+        lines = [
+            f"# TYPE {self.prefix}_operation_seconds histogram",
+        ]
+        extra_labels = f",{labels}" if labels else ""
+        for operation, histogram in sorted(histograms.items()):
+            operation_labels = f'operation="{label_value(operation)}"{extra_labels}'
+            cumulative = 0
+            for le, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(f'{self.prefix}_operation_seconds_bucket{{{operation_labels},le="{le}"}} {cumulative}')
+            lines.append(f"{self.prefix}_operation_seconds_sum{{{operation_labels}}} {histogram.sum}")
+            lines.append(f"{self.prefix}_operation_seconds_count{{{operation_labels}}} {histogram.count}")
+        for counter, value in sorted(counters.items()):
+            lines.append(f"# TYPE {self.prefix}_{counter}_total counter")
+            lines.append(f"{self.prefix}_{counter}_total{{{labels}}} {value}" if labels else f"{self.prefix}_{counter}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def _flush_every(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+
+# label values can't have raw backslashes, double quotes or line feeds
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Timer:
+    def __init__(self, registry, operation):
+        self.registry = registry
+        self.operation = operation
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.operation, time.perf_counter() - self.started)
+
+
+class NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class NoopRegistry:
+    # used with MONITOR_METRICS=0: every call returns right away
+    noop_timer = NoopTimer()
+
+    def observe(self, operation, seconds):
+        pass
+
+    def inc(self, counter, value=1):
+        pass
+
+    def timer(self, operation):
+        return self.noop_timer
+
+    def share(self, redis_client, interval=10):
+        pass
+
+    def render(self):
+        return ""
+
+
+registry = MetricsRegistry() if os.environ.get("MONITOR_METRICS", "1") != "0" else NoopRegistry()
+
+
+def timer(operation):
+    return registry.timer(operation)
+
+
+def inc(counter, value=1):
+    registry.inc(counter, value)
+
+
+def observe(operation, seconds):
+    registry.observe(operation, seconds)
+
+
+def render():
+    return registry.render()
+
+
+# adds up the metrics of all the processes in redis (see MetricsRegistry)
+def share(redis_client, interval=10):
+    registry.share(redis_client, interval)
+
+
+# decorator that records the latency of every call of the function
+def timed(operation):
+    def decorator(f):
+        if isinstance(registry, NoopRegistry):
+            return f
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with registry.timer(operation):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,19 @@
+# adaptive polling for check_task_status: the checks are frequent while the tasks are changing
+# and back off exponentially while nothing changes; when the tasks are expected to finish
+# (from the runtimes of the previous tasks with the same name) the check is moved to that moment
+
+
+# seconds to wait before the next check if nothing else is known
+# it goes back to min_interval as soon as something changes
+def next_backoff(backoff, changed, min_interval=2, max_interval=60, factor=2):
+    if changed or not backoff:
+        return min_interval
+    return min(backoff * factor, max_interval)
+
+
+# seconds to wait before the next check: the backoff, or less if a task is expected to finish before that
+# expected_finish_times: timestamps; the ones in the past are tasks running late, which follow the backoff
+# slack: seconds for the worker to store the result after the task has finished
+def next_check_in(backoff, expected_finish_times, now, min_interval=2, slack=1.0):
+    upcoming = [finish_time + slack - now for finish_time in expected_finish_times if finish_time + slack > now]
+    return max(min([backoff] + upcoming), min_interval)
@@ -0,0 +1,53 @@
+import time
+
+# custom task state with the progress of a running task, stored in the result backend like STARTED
+# meta: {"percent": 0-100, "message": str or None}
+# https://docs.celeryq.dev/en/latest/userguide/tasks.html#custom-states
+PROGRESS = "PROGRESS"
+# custom event with the same meta, for the TaskEventTracker (see events.EVENT_STATUS)
+PROGRESS_EVENT = "task-progress"
+
+
+class ProgressReporter:
+    # progress of a bound task (@celery_app.task(bind=True)), to be called as often as the task wants:
+    # only the last value is kept and it's written at most once every `min_interval` seconds,
+    # so a tight loop doesn't send one write to redis (and one event to the broker) per iteration
+    # the last value is always written when the reporter is flushed (or used as a context manager)
+    #
+    #     with ProgressReporter(self) as progress:
+    #         for i, item in enumerate(items):
+    #             progress.update(100 * i / len(items), f"item {i} of {len(items)}")
+
+    def __init__(self, task, min_interval=2.0, send_events=True):
+        self.task = task
+        self.min_interval = min_interval
+        self.send_events = send_events
+        self._pending = None
+        self._written = None
+        self._written_at = 0.0
+
+    def update(self, percent, message=None):
+        self._pending = {"percent": round(min(max(float(percent), 0.0), 100.0), 1), "message": message}
+        if time.monotonic() - self._written_at >= self.min_interval or self._pending["percent"] >= 100:
+            self.flush()
+
+    def flush(self):
+        # nothing new, or the task isn't running in a worker (e.g. called directly)
+        if self._pending is None or self._pending == self._written or not self.task.request.id:
+            return
+        meta = self._pending
+        self.task.update_state(state=PROGRESS, meta=meta)
+        if self.send_events:
+            try:
+                self.task.send_event(PROGRESS_EVENT, **meta)
+            # the progress is still in the result backend
+            except Exception as e:
+                print(f"Couldn't send the progress event of {self.task.request.id} ({e})")
+        self._written = meta
+        self._written_at = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
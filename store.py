@@ -0,0 +1,350 @@
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+from events import STATUS_RANK
+from utils import FINAL_STATUSES
+
+# columns of the grid; the store keeps some extra fields:
+# sent_at/done_at (timestamps used to sort by time_start/time_end), submitted_by (client_id of the user that sent the task)
+# and updated_at (timestamp of the last change of the row)
+GRID_FIELDS = [
+    "id", "name", "args", "kwargs", "time_start", "time_end", "status",
+    "progress", "progress_message", "result_size", "result_preview", "cluster",
+]
+STORE_FIELDS = GRID_FIELDS + ["submitted_by", "sent_at", "done_at", "updated_at"]
+
+# grid columns sorted by a different field of the store
+SORT_FIELDS = {"time_start": "sent_at", "time_end": "done_at"}
+
+
+def grid_row(row):
+    return {k: row.get(k) for k in GRID_FIELDS}
+
+
+# args/kwargs can come as lists/dicts (e.g. from the inspector): they are stored as text, like in the grid
+def sql_value(value):
+    return value if value is None or isinstance(value, (str, int, float)) else str(value)
+
+
+# changes to apply to the stored task (None if it's a new one) to upsert `row`
+# the status never goes back (e.g. events that arrive out of order)
+# and final statuses don't change (e.g. a task cancelled after it was completed)
+def task_changes(stored, row):
+    # compared as they are stored (e.g. the args of the inspector are lists)
+    row = {k: sql_value(v) for k, v in row.items()}
+    if stored is None:
+        stored = {}
+        row = {"sent_at": time.time(), **row}
+    elif row.get("status") and (
+        STATUS_RANK.get(row["status"], -1) < STATUS_RANK.get(stored.get("status"), -1)
+        or stored.get("status") in FINAL_STATUSES
+    ):
+        row = {k: v for k, v in row.items() if k not in ["status", "time_end", "done_at"]}
+    # the progress reported by a task (see progress.py) doesn't change once it has finished
+    if stored.get("status") in FINAL_STATUSES:
+        row = {k: v for k, v in row.items() if k not in ["progress", "progress_message"]}
+    changes = {k: v for k, v in row.items() if k in STORE_FIELDS and v is not None and stored.get(k) != v}
+    if changes.get("status") in FINAL_STATUSES and not stored.get("done_at"):
+        changes.setdefault("done_at", time.time())
+    if changes:
+        changes["updated_at"] = time.time()
+    return changes
+
+
+# sql for the ag-grid text filters (LIKE is case insensitive in sqlite)
+TEXT_FILTER_SQL = {
+    "contains": ("{col} LIKE ? ESCAPE '\\'", "%{}%"),
+    "notContains": ("COALESCE({col}, '') NOT LIKE ? ESCAPE '\\'", "%{}%"),
+    "startsWith": ("{col} LIKE ? ESCAPE '\\'", "{}%"),
+    "endsWith": ("{col} LIKE ? ESCAPE '\\'", "%{}"),
+    "equals": ("{col} = ? COLLATE NOCASE", None),
+    "notEqual": ("COALESCE({col}, '') != ? COLLATE NOCASE", None),
+}
+
+
+# sql for the ag-grid number filters; inRange excludes both ends, like ag-grid by default
+# https://www.ag-grid.com/javascript-data-grid/filter-number/#number-filter-model
+NUMBER_FILTER_SQL = {
+    "equals": "{col} = ?",
+    "notEqual": "({col} IS NULL OR {col} != ?)",
+    "greaterThan": "{col} > ?",
+    "greaterThanOrEqual": "{col} >= ?",
+    "lessThan": "{col} < ?",
+    "lessThanOrEqual": "{col} <= ?",
+    "inRange": "{col} > ? AND {col} < ?",
+}
+
+
+# sql condition and parameters for the filter of one column (text or number filter)
+# https://www.ag-grid.com/javascript-data-grid/filter-text/#text-filter-model
+def text_filter_sql(col, column_filter):
+    if "conditions" in column_filter:
+        conditions = [
+            text_filter_sql(col, {"filterType": column_filter.get("filterType"), **c}) for c in column_filter["conditions"]
+        ]
+        operator = " AND " if column_filter.get("operator") == "AND" else " OR "
+        sql = operator.join(f"({c})" for c, _ in conditions)
+        return sql, [p for _, params in conditions for p in params]
+    filter_type = column_filter.get("type", "contains")
+    if filter_type == "blank":
+        return f"COALESCE({col}, '') = ''", []
+    elif filter_type == "notBlank":
+        return f"COALESCE({col}, '') != ''", []
+    elif column_filter.get("filterType") == "number":
+        return number_filter_sql(col, column_filter)
+    sql, pattern = TEXT_FILTER_SQL.get(filter_type, TEXT_FILTER_SQL["contains"])
+    value = str(column_filter.get("filter") or "")
+    if pattern:
+        value = pattern.format(value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+    return sql.format(col=col), [value]
+
+
+def number_filter_sql(col, column_filter):
+    filter_type = column_filter.get("type", "equals")
+    keys = ["filter", "filterTo"] if filter_type == "inRange" else ["filter"]
+    try:
+        params = [float(column_filter[k]) for k in keys]
+    # the filter is still being typed: it doesn't filter anything yet
+    except (KeyError, TypeError, ValueError):
+        return "1", []
+    return NUMBER_FILTER_SQL.get(filter_type, NUMBER_FILTER_SQL["equals"]).format(col=col), params
+
+
+class SQLiteTaskStore:
+    # tasks of the grid indexed by status, name, time and user, so the grid can ask for
+    # one page of (filtered and sorted) rows instead of holding all of them
+    # it's on disk: it's shared by all the gunicorn workers and it keeps the task history between restarts
+    # - finished tasks are deleted after `retention_days` and only the newest `max_tasks` are kept;
+    #   this runs every `compaction_interval` seconds
+    # - sqlite connections can't be shared by threads, so every thread has its own
+
+    def __init__(self, path="tasks.db", retention_days=7, max_tasks=100000, compaction_interval=3600):
+        self.path = path
+        self.retention_days = retention_days
+        self.max_tasks = max_tasks
+        self.compaction_interval = compaction_interval
+        self._local = threading.local()
+        self._compacted_at = time.time()
+        db = self._db()
+        # has to be set before creating the tables
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute(f"""
+            CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY, name TEXT, args TEXT, kwargs TEXT, time_start TEXT, time_end TEXT,
+                status TEXT, submitted_by TEXT, sent_at REAL, done_at REAL, updated_at REAL,
+                progress REAL, progress_message TEXT, result_size INTEGER, result_preview TEXT, cluster TEXT
+            )
+        """)
+        # columns added after the first version of the table
+        columns = {row["name"] for row in db.execute("PRAGMA table_info(tasks)")}
+        for column, column_type in [
+            ("progress", "REAL"), ("progress_message", "TEXT"), ("result_size", "INTEGER"), ("result_preview", "TEXT"),
+            ("cluster", "TEXT"),
+        ]:
+            if column not in columns:
+                db.execute(f"ALTER TABLE tasks ADD COLUMN {column} {column_type}")
+        db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status COLLATE NOCASE)")
+        db.execute("CREATE INDEX IF NOT EXISTS tasks_name ON tasks (name COLLATE NOCASE)")
+        db.execute("CREATE INDEX IF NOT EXISTS tasks_sent_at ON tasks (sent_at)")
+        db.execute("CREATE INDEX IF NOT EXISTS tasks_updated_at ON tasks (updated_at)")
+        db.execute("CREATE INDEX IF NOT EXISTS tasks_submitted_by ON tasks (submitted_by, sent_at)")
+        # ids of the tasks deleted by compact, so the grids that have them loaded can remove them (see removed_since)
+        db.execute("CREATE TABLE IF NOT EXISTS removed_tasks (id TEXT PRIMARY KEY, removed_at REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS removed_tasks_removed_at ON removed_tasks (removed_at)")
+
+    def upsert(self, row: dict):
+        changed = self.upsert_many([row])
+        return changed[0] if changed else None
+
+    # one transaction for all the rows; returns the grid rows that changed
+    @metrics.timed("store.upsert_many")
+    def upsert_many(self, rows):
+        rows = list(rows)
+        if not rows:
+            return []
+        db = self._db()
+        # IMMEDIATE: takes the write lock before reading, so the rows don't change in between
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            stored = self._select(db, {row["id"] for row in rows})
+            changed = {}
+            for row in rows:
+                changes = task_changes(stored.get(row["id"]), row)
+                if changes:
+                    stored[row["id"]] = {**stored.get(row["id"], {"id": row["id"]}), **changes}
+                    changed[row["id"]] = stored[row["id"]]
+            if changed:
+                db.executemany(
+                    f"INSERT OR REPLACE INTO tasks ({', '.join(STORE_FIELDS)}) VALUES ({', '.join('?' * len(STORE_FIELDS))})",
+                    [[sql_value(row.get(f)) for f in STORE_FIELDS] for row in changed.values()],
+                )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        if time.time() - self._compacted_at > self.compaction_interval:
+            self.compact()
+        return [grid_row(row) for row in changed.values()]
+
+    def get(self, task_id):
+        row = self._select(self._db(), [task_id]).get(task_id)
+        return grid_row(row) if row else None
+
+    @metrics.timed("store.pending")
+    def pending(self, submitted_by=None):
+        sql = "SELECT * FROM tasks WHERE status IN ('Queued', 'Running')"
+        params = []
+        if submitted_by is not None:
+            sql += " AND submitted_by = ?"
+            params.append(submitted_by)
+        return [grid_row(dict(row)) for row in self._db().execute(sql, params)]
+
+    @metrics.timed("store.changed_since")
+    def changed_since(self, since, submitted_by=None):
+        sql = "SELECT * FROM tasks WHERE updated_at > ?"
+        params = [since]
+        if submitted_by is not None:
+            sql += " AND submitted_by = ?"
+            params.append(submitted_by)
+        return [grid_row(dict(row)) for row in self._db().execute(sql, params)]
+
+    # ids of the tasks deleted after the timestamp `since`
+    @metrics.timed("store.removed_since")
+    def removed_since(self, since):
+        return [row["id"] for row in self._db().execute("SELECT id FROM removed_tasks WHERE removed_at > ?", [since])]
+
+    @metrics.timed("store.query")
+    def query(self, start=0, end=100, filter_model=None, sort_model=None, submitted_by=None):
+        where = []
+        params = []
+        # colId comes from the browser: only the grid columns are allowed
+        for col, column_filter in (filter_model or {}).items():
+            if col in GRID_FIELDS:
+                sql, filter_params = text_filter_sql(col, column_filter)
+                where.append(f"({sql})")
+                params += filter_params
+        if submitted_by is not None:
+            where.append("submitted_by = ?")
+            params.append(submitted_by)
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+        # newest tasks first by default; sqlite sorts NULL first (empty values go first in ascending order)
+        order_by = [
+            f"{SORT_FIELDS.get(s['colId'], s['colId'])} {'DESC' if s['sort'] == 'desc' else 'ASC'}"
+            for s in (sort_model or [{"colId": "time_start", "sort": "desc"}]) if s["colId"] in GRID_FIELDS
+        ]
+        order_by_sql = f"ORDER BY {', '.join(order_by + ['id'])}"
+        db = self._db()
+        rows = db.execute(
+            f"SELECT * FROM tasks {where_sql} {order_by_sql} LIMIT ? OFFSET ?",
+            params + [max(end - start, 0), start],
+        ).fetchall()
+        row_count = db.execute(f"SELECT COUNT(*) FROM tasks {where_sql}", params).fetchone()[0]
+        return [grid_row(dict(row)) for row in rows], row_count
+
+    # retention policy: removes old finished tasks and frees the space they used
+    # the removed ids are kept for a day (a grid that has been synced less often reloads anyway)
+    @metrics.timed("store.compact")
+    def compact(self):
+        now = self._compacted_at = time.time()
+        db = self._db()
+        final_statuses = ", ".join(f"'{s}'" for s in FINAL_STATUSES)
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                f"INSERT OR REPLACE INTO removed_tasks SELECT id, ? FROM tasks WHERE status IN ({final_statuses}) AND COALESCE(done_at, updated_at) < ?",
+                [now, now - self.retention_days * 24 * 3600],
+            )
+            db.execute(
+                f"INSERT OR REPLACE INTO removed_tasks SELECT id, ? FROM tasks WHERE status IN ({final_statuses}) ORDER BY sent_at DESC LIMIT -1 OFFSET ?",
+                [now, self.max_tasks],
+            )
+            db.execute("DELETE FROM tasks WHERE id IN (SELECT id FROM removed_tasks WHERE removed_at = ?)", [now])
+            db.execute("DELETE FROM removed_tasks WHERE removed_at < ?", [now - 24 * 3600])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("PRAGMA incremental_vacuum")
+        db.execute("PRAGMA optimize")
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # isolation_level=None: transactions are handled explicitly (BEGIN IMMEDIATE)
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            # WAL: readers don't block the writer (and the other way around)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            self._local.db = db
+        return db
+
+    def _select(self, db, task_ids):
+        task_ids = list(task_ids)
+        stored = {}
+        # sqlite has a limit on the number of parameters per query
+        for i in range(0, len(task_ids), 500):
+            chunk = task_ids[i:i + 500]
+            for row in db.execute(f"SELECT * FROM tasks WHERE id IN ({', '.join('?' * len(chunk))})", chunk):
+                stored[row["id"]] = dict(row)
+        return stored
+
+
+class TaskStoreWriter:
+    # upserts the rows added from other threads (the TaskEventTracker listeners) in the background,
+    # all the rows of the last `interval` seconds in one transaction, so the event receiver never waits
+    # for the sqlite write lock; every gunicorn worker receives the same events, and the rows that the
+    # other workers have already written don't change anything (see task_changes)
+    # if the store falls behind by more than `max_rows` rows the new ones are dropped (the checks
+    # of check_task_status still update them)
+
+    def __init__(self, task_store, interval=0.2, max_rows=10000):
+        self.task_store = task_store
+        self.interval = interval
+        self.rows = queue.Queue(maxsize=max_rows)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add(self, row):
+        if self._thread is None:
+            self.start()
+        try:
+            self.rows.put_nowait(row)
+        except queue.Full:
+            metrics.inc("store_rows_dropped")
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="task-store-writer", daemon=True)
+        self._thread.start()
+
+    # writes the rows waiting in the queue now; returns how many
+    def flush(self):
+        rows = self._drain()
+        # in order: the rows of the same task are applied one after the other (see upsert_many)
+        if rows:
+            self.task_store.upsert_many(rows)
+        return len(rows)
+
+    def _drain(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self.rows.get_nowait())
+            except queue.Empty:
+                return rows
+
+    def _run(self):
+        while True:
+            row = self.rows.get()
+            # the rows that arrive meanwhile go in the same transaction
+            time.sleep(self.interval)
+            try:
+                self.task_store.upsert_many([row] + self._drain())
+            except Exception:
+                metrics.inc("store_write_errors")
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+import metrics
+from throughput import queue_depths
+
+# priority classes shown in the layout -> send_task options
+# with the redis broker the priorities go from 0 (first) to 9 (last), see PRIORITY_TRANSPORT_OPTIONS;
+# a class can also have its own "queue" (the workers have to consume it, e.g. celery worker -Q celery,low)
+PRIORITY_CLASSES = {
+    "high": {"priority": 0},
+    "normal": {"priority": 5},
+    "low": {"priority": 9},
+}
+# the redis transport only has one list per queue unless it's told to have one per priority
+# https://docs.celeryq.dev/en/latest/userguide/routing.html#redis-message-priorities
+PRIORITY_TRANSPORT_OPTIONS = {
+    "priority_steps": list(range(10)),
+    "sep": ":",
+    "queue_order_strategy": "priority",
+}
+# the score of the tasks in the pending zset: the priority first, then the submission order
+PRIORITY_SCORE = 1e12
+
+# refills the bucket of KEYS[1] (`rate` tokens per second, up to `burst`) and takes up to ARGV[4] tokens
+# returns the tokens taken; it runs in redis so all the gunicorn workers share the buckets
+TOKEN_BUCKET_SCRIPT = """
+local rate, burst, now, requested = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local taken = math.min(math.floor(tokens), requested)
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens - taken), "updated_at", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return taken
+"""
+
+
+class SubmissionQueue:
+    # durable queue in redis in front of send_task, so bursts of clicks don't go straight to the workers:
+    # - dedup: the same (task name, kwargs) submitted again by the same user within `dedup_ttl` seconds
+    #   isn't sent again, the ids of the first submission are returned instead
+    # - every user has a token bucket of `burst` tasks refilled at `rate` tasks/sec; the tasks over it are rejected
+    #   (and a submission can't have more than `max_count` tasks)
+    # - accepted tasks get their task id right away (the grid shows them as Queued) and wait in a zset
+    #   ordered by priority class and submission time
+    # - the dispatcher (a thread per gunicorn worker, one of them at a time) sends them to the broker while
+    #   the broker queue has less than `max_queued` messages, so the backlog stays here, where a high
+    #   priority task goes before the normal ones submitted earlier
+    # the pending tasks survive restarts of the app
+
+    def __init__(self, celery_app, redis_client, rate=10.0, burst=1000, max_count=1000, dedup_ttl=300, max_queued=10,
+                 dispatch_interval=1.0, prefix="celery_monitor:submit:", priority_classes=PRIORITY_CLASSES):
+        self.celery_app = celery_app
+        self.redis_client = redis_client
+        self.rate = rate
+        self.burst = burst
+        self.max_count = max_count
+        self.dedup_ttl = dedup_ttl
+        self.max_queued = max_queued
+        self.dispatch_interval = dispatch_interval
+        self.prefix = prefix
+        self.priority_classes = priority_classes
+        self._token_bucket = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+        self._wake_up = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # returns (task ids, submission status): "submitted", "duplicate" (the ids of the first submission)
+    # or "rate_limited" (the ids of the tasks that fit in the bucket, maybe none)
+    @metrics.timed("submission.submit")
+    def submit(self, user, task_name, task_kwargs, count=1, priority="normal"):
+        if priority not in self.priority_classes:
+            raise ValueError(f"unknown priority class: {priority}")
+        if not 1 <= count <= self.max_count:
+            raise ValueError(f"a submission has between 1 and {self.max_count} tasks, not {count}")
+        dedup_key = self.prefix + "dedup:" + hashlib.sha1(
+            json.dumps([str(user), task_name, task_kwargs], sort_keys=True, default=str).encode()
+        ).hexdigest()
+        task_ids = [str(uuid.uuid4()) for _ in range(count)]
+        if not self.redis_client.set(dedup_key, json.dumps(task_ids), nx=True, ex=int(self.dedup_ttl)):
+            metrics.inc("submissions_deduplicated")
+            return json.loads(self.redis_client.get(dedup_key) or "[]"), "duplicate"
+
+        taken = self._token_bucket(keys=[self.prefix + "bucket:" + str(user)], args=[self.rate, self.burst, time.time(), count])
+        status = "submitted"
+        if taken < count:
+            metrics.inc("submissions_rate_limited", count - taken)
+            task_ids, status = task_ids[:taken], "rate_limited"
+            # the rejected tasks can be submitted again
+            if task_ids:
+                self.redis_client.set(dedup_key, json.dumps(task_ids), xx=True, keepttl=True)
+            else:
+                self.redis_client.delete(dedup_key)
+        if task_ids:
+            # a counter shared by all the processes keeps the order of the submissions
+            last = self.redis_client.incrby(self.prefix + "sequence", len(task_ids))
+            score = self.priority_classes[priority].get("priority", 0) * PRIORITY_SCORE + last - len(task_ids)
+            task = json.dumps({"name": task_name, "kwargs": task_kwargs, "priority": priority}, default=str)
+            with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(self.prefix + "tasks", mapping={task_id: task for task_id in task_ids})
+                pipe.zadd(self.prefix + "pending", {task_id: score + i for i, task_id in enumerate(task_ids)})
+                pipe.execute()
+            self._wake_up.set()
+        return task_ids, status
+
+    # removes the tasks that haven't been sent yet; returns their ids
+    def cancel(self, task_ids):
+        if not task_ids:
+            return []
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            for task_id in task_ids:
+                pipe.zrem(self.prefix + "pending", task_id)
+            pipe.hdel(self.prefix + "tasks", *task_ids)
+            removed = pipe.execute()[:-1]
+        return [task_id for task_id, was_pending in zip(task_ids, removed) if was_pending]
+
+    def pending_count(self):
+        return self.redis_client.zcard(self.prefix + "pending")
+
+    # sends the first pending tasks to the broker, as many as fit under `max_queued`
+    # returns the ids of the tasks sent
+    @metrics.timed("submission.dispatch")
+    def dispatch(self):
+        lock = self.redis_client.lock(self.prefix + "dispatcher", timeout=30)
+        if not lock.acquire(blocking=False):
+            return []
+        try:
+            if not self.pending_count():
+                return []
+            depth = sum(queue_depths(self.celery_app).values())
+            if depth >= self.max_queued:
+                return []
+            # zpopmin: a task can only be popped once, whatever the process
+            popped = {
+                task_id.decode() if isinstance(task_id, bytes) else task_id: score
+                for task_id, score in self.redis_client.zpopmin(self.prefix + "pending", self.max_queued - depth)
+            }
+            if not popped:
+                return []
+            tasks = self.redis_client.hmget(self.prefix + "tasks", list(popped))
+            # the ones without a task have been cancelled meanwhile
+            tasks = [(task_id, json.loads(task)) for task_id, task in zip(popped, tasks) if task]
+            sent = []
+            try:
+                # all the tasks are published with the same producer (and broker connection)
+                with metrics.timer("broker.send_tasks"), self.celery_app.producer_or_acquire() as producer:
+                    for task_id, task in tasks:
+                        self.celery_app.send_task(
+                            task["name"], kwargs=task["kwargs"], task_id=task_id, producer=producer,
+                            **self.priority_classes.get(task["priority"], {}),
+                        )
+                        sent.append(task_id)
+            # the broker is down: the ones that haven't been sent go back to the queue in the same place
+            except Exception:
+                self.redis_client.zadd(
+                    self.prefix + "pending", {task_id: popped[task_id] for task_id, _ in tasks[len(sent):]}
+                )
+                raise
+            finally:
+                # the tasks that have been sent (or cancelled) are done
+                unsent = {task_id for task_id, _ in tasks[len(sent):]}
+                done = [task_id for task_id in popped if task_id not in unsent]
+                if done:
+                    self.redis_client.hdel(self.prefix + "tasks", *done)
+                metrics.inc("submissions_dispatched", len(sent))
+            return sent
+        finally:
+            try:
+                lock.release()
+            # the lock expired while dispatching
+            except Exception:
+                pass
+
+    # starts the dispatcher thread of this process (once)
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="submission-dispatcher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            # submit wakes it up, so the tasks of this process don't wait for the interval
+            self._wake_up.wait(self.dispatch_interval)
+            self._wake_up.clear()
+            try:
+                self.dispatch()
+            except Exception:
+                metrics.inc("submission_dispatch_errors")
+                time.sleep(self.dispatch_interval)
@@ -0,0 +1,77 @@
+import json
+
+import fakeredis
+import pytest
+from celery import Celery, states
+
+import backend
+
+
+@pytest.fixture
+def celery_app():
+    celery_app = Celery("tests", backend="redis://localhost:6379/0")
+    celery_app.backend.client = fakeredis.FakeRedis()
+    return celery_app
+
+
+def stored_size(celery_app, task_id):
+    return celery_app.backend.client.strlen(celery_app.backend.get_key_for_task(task_id))
+
+
+def test_task_metas(celery_app):
+    celery_app.backend.store_result("done", {"rows": [1, 2, 3]}, states.SUCCESS)
+    task_metas = backend.get_task_metas(celery_app, ["done", "unknown"])
+    assert task_metas["done"]["status"] == states.SUCCESS
+    assert task_metas["done"]["result"] == {"rows": [1, 2, 3]}
+    # the size of the result, not of the whole stored meta
+    assert task_metas["done"]["result_size"] == len(json.dumps({"rows": [1, 2, 3]}))
+    assert task_metas["unknown"] == {"status": states.PENDING, "result": None, "result_size": 0}
+
+
+def test_small_results_arent_capped(celery_app):
+    celery_app.backend.store_result("done", "small", states.SUCCESS)
+    assert backend.get_task_metas(celery_app, ["done"], max_result_bytes=1000) == backend.get_task_metas(celery_app, ["done"])
+
+
+def test_big_results_are_capped(celery_app):
+    result = "x" * 10000
+    celery_app.backend.store_result("done", result, states.SUCCESS)
+    task_meta = backend.get_task_metas(celery_app, ["done"], max_result_bytes=1000)["done"]
+    assert task_meta["status"] == states.SUCCESS
+    assert task_meta["result"] is None
+    assert task_meta["result_truncated"]
+    assert task_meta["result_preview"] == json.dumps(result)[:backend.RESULT_PREVIEW_CHARS]
+    # what is stored from the result on
+    assert len(json.dumps(result)) < task_meta["result_size"] < stored_size(celery_app, "done")
+    assert backend.result_fields(task_meta) == {
+        "result_size": task_meta["result_size"], "result_preview": task_meta["result_preview"]
+    }
+
+
+def test_small_results_of_big_metas_are_fetched(celery_app):
+    celery_app.backend.store_result("failed", ValueError("bad value"), states.FAILURE, traceback="line\n" * 2000)
+    assert stored_size(celery_app, "failed") > 1000
+    task_meta = backend.get_task_metas(celery_app, ["failed"], max_result_bytes=1000)["failed"]
+    assert task_meta["status"] == states.FAILURE
+    assert task_meta["result"]["exc_message"] == ["bad value"]
+    assert not task_meta.get("result_truncated")
+    assert task_meta["result_size"] == len(json.dumps(task_meta["result"]))
+
+
+def test_truncated_meta():
+    task_meta = backend.truncated_meta(b'{"status": "FAILURE", "result": 12345', 100)
+    # the number could go on
+    assert task_meta["result"] is None and task_meta["result_truncated"]
+    assert task_meta["status"] == states.FAILURE
+    assert task_meta["result_preview"] == "12345"
+    assert task_meta["result_size"] == 100 - len(b'{"status": "FAILURE", "result": ')
+    assert backend.truncated_meta(b'{"status": "SUCCESS", "result": [1, 2], "traceback"', 100)["result"] == [1, 2]
+
+
+def test_stream_task_result(celery_app):
+    celery_app.backend.store_result("done", "x" * 1000, states.SUCCESS)
+    stored = celery_app.backend.client.get(celery_app.backend.get_key_for_task("done"))
+    chunks = list(backend.stream_task_result(celery_app, "done", chunk_size=100))
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert b"".join(chunks) == stored
+    assert backend.stream_task_result(celery_app, "unknown") is None
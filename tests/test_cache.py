@@ -0,0 +1,90 @@
+import threading
+import time
+
+import fakeredis
+import pytest
+
+from cache import SharedCache
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis()
+
+
+def counting_fetch(value):
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return value
+
+    return fetch, calls
+
+
+def test_fresh_values_are_fetched_once(redis_client):
+    cache = SharedCache(redis_client, ttl=60)
+    fetch, calls = counting_fetch({"a": 1})
+    assert cache.get("key", fetch) == {"a": 1}
+    assert cache.get("key", fetch) == {"a": 1}
+    # another process (or session) sharing redis doesn't fetch it either
+    assert SharedCache(redis_client, ttl=60).get("key", fetch) == {"a": 1}
+    assert len(calls) == 1
+
+
+def test_stale_values_are_returned_while_refreshing(redis_client):
+    cache = SharedCache(redis_client, ttl=0.1, stale_ttl=60)
+    cache.get("key", lambda: "old")
+    time.sleep(0.2)
+    refreshed = threading.Event()
+
+    def fetch():
+        refreshed.set()
+        return "new"
+
+    assert cache.get("key", fetch) == "old"
+    assert refreshed.wait(1)
+    time.sleep(0.1)
+    assert cache.get("key", fetch) == "new"
+
+
+def test_stale_values_are_refreshed_by_one_process_at_a_time(redis_client):
+    cache = SharedCache(redis_client, ttl=0.1, stale_ttl=60)
+    cache.get("key", lambda: "old")
+    time.sleep(0.2)
+    # somebody else is refreshing it
+    lock = cache._lock("key")
+    assert lock.acquire(blocking=False)
+    fetch, calls = counting_fetch("new")
+    assert cache.get("key", fetch) == "old"
+    time.sleep(0.1)
+    assert calls == []
+    lock.release()
+
+
+def test_missing_values_are_fetched_by_one_process_and_waited_for_by_the_rest(redis_client):
+    cache = SharedCache(redis_client, ttl=60)
+    lock = cache._lock("key")
+    assert lock.acquire(blocking=False)
+    # the process holding the lock stores the value a bit later
+    timer = threading.Timer(0.3, cache._refresh, args=("key", lambda: "value", lock))
+    timer.start()
+    fetch, calls = counting_fetch("other value")
+    assert cache.get("key", fetch) == "value"
+    assert calls == []
+    timer.join()
+
+
+def test_waiting_gives_up_after_the_lock_timeout(redis_client):
+    cache = SharedCache(redis_client, ttl=60, lock_timeout=0.3)
+    assert cache._lock("key").acquire(blocking=False)
+    fetch, calls = counting_fetch("value")
+    assert cache.get("key", fetch) == "value"
+    assert len(calls) == 1
+
+
+def test_values_expire_after_the_stale_ttl(redis_client):
+    cache = SharedCache(redis_client, ttl=0.1, stale_ttl=0.2)
+    cache.get("key", lambda: "old")
+    time.sleep(0.3)
+    assert cache.get("key", lambda: "new") == "new"
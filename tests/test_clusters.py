@@ -0,0 +1,41 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from clusters import ClusterRegistry
+
+
+def fake_cluster(name, max_polls=2):
+    return SimpleNamespace(name=name, max_polls=max_polls, polls=threading.BoundedSemaphore(max_polls))
+
+
+def test_a_cluster_that_is_down_doesnt_stall_the_rest():
+    healthy, down = fake_cluster("healthy"), fake_cluster("down")
+    registry = ClusterRegistry(healthy)
+    registry.add(down)
+    released = threading.Event()
+    calls = []
+
+    def poll(cluster):
+        calls.append(cluster.name)
+        if cluster is down:
+            released.wait()
+        return cluster.name
+
+    try:
+        for _ in range(5):
+            assert registry.poll(poll, deadline=0.1) == {"healthy": "healthy", "down": None}
+        # the polls of the cluster that is down that didn't finish aren't sent again
+        assert calls.count("down") == down.max_polls
+        assert calls.count("healthy") == 5
+    finally:
+        released.set()
+    time.sleep(0.1)
+    assert registry.poll(poll, deadline=1) == {"healthy": "healthy", "down": "down"}
+
+
+def test_failed_polls_are_none():
+    cluster = fake_cluster("default")
+    registry = ClusterRegistry(cluster)
+    assert registry.poll(lambda cluster: 1 / 0, deadline=1) == {"default": None}
+    assert registry.poll(lambda cluster: 1, deadline=1) == {"default": 1}
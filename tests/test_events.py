@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+from events import TaskEventTracker, task_row
+from progress import PROGRESS_EVENT
+
+
+def event(event_type, task_id="t1", timestamp=100.0, **fields):
+    return {"type": event_type, "uuid": task_id, "timestamp": timestamp, **fields}
+
+
+def test_events_out_of_order_dont_go_back():
+    tracker = TaskEventTracker(None, cluster="default")
+    tracker._on_event(event("task-succeeded", timestamp=103.0))
+    tracker._on_event(event("task-started", timestamp=101.0, hostname="worker1"))
+    tracker._on_event(event("task-sent", timestamp=100.0, name="tasks.add", kwargs={"x": 1}))
+    task_info = tracker.get("t1")
+    assert task_info["status"] == "Complete"
+    assert task_info["progress"] == 100.0
+    # the fields of the late events are kept anyway
+    assert task_info["name"] == "tasks.add"
+    assert task_info["hostname"] == "worker1"
+    assert (task_info["sent_at"], task_info["started_at"], task_info["done_at"]) == (100.0, 101.0, 103.0)
+    assert task_row(task_info)["cluster"] == "default"
+
+
+def test_progress_after_a_final_status_is_ignored():
+    tracker = TaskEventTracker(None)
+    tracker._on_event(event("task-started"))
+    tracker._on_event(event(PROGRESS_EVENT, percent=40.0, message="half way"))
+    assert (tracker.get("t1")["progress"], tracker.get("t1")["progress_message"]) == (40.0, "half way")
+    tracker._on_event(event("task-failed", timestamp=102.0))
+    tracker._on_event(event(PROGRESS_EVENT, timestamp=101.0, percent=60.0, message="late"))
+    task_info = tracker.get("t1")
+    assert task_info["status"] == "Failed"
+    assert (task_info["progress"], task_info["progress_message"]) == (40.0, "half way")
+
+
+def test_unknown_events_are_ignored():
+    tracker = TaskEventTracker(None)
+    tracker._on_event(event("worker-heartbeat"))
+    tracker._on_event({"type": "task-sent"})
+    assert tracker.tasks == {}
+
+
+def test_least_recently_updated_tasks_are_evicted():
+    tracker = TaskEventTracker(None, max_tasks=2)
+    tracker._on_event(event("task-sent", "t1"))
+    tracker._on_event(event("task-sent", "t2"))
+    # t1 is updated, so t2 is the oldest one
+    tracker._on_event(event("task-started", "t1"))
+    tracker._on_event(event("task-sent", "t3"))
+    assert list(tracker.tasks) == ["t1", "t3"]
+    assert tracker.get("t2") is None
+
+
+def test_subscribers_and_listeners_get_copies():
+    tracker = TaskEventTracker(None)
+    subscriber = tracker.subscribe()
+    changes = []
+    tracker.add_listener(changes.append)
+    tracker._on_event(event("task-sent"))
+    streamed = subscriber.get_nowait()
+    streamed["status"] = "Complete"
+    changes[0]["status"] = "Complete"
+    assert tracker.get("t1")["status"] == "Queued"
+
+
+def test_workers_that_come_online_are_told_to_send_events():
+    enabled = []
+    celery_app = SimpleNamespace(control=SimpleNamespace(enable_events=lambda **kwargs: enabled.append(kwargs)))
+    tracker = TaskEventTracker(celery_app)
+    tracker._on_worker_online({"type": "worker-online", "hostname": "celery@worker1"})
+    assert enabled == [{"destination": ["celery@worker1"]}]
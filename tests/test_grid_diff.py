@@ -0,0 +1,53 @@
+import fakeredis
+import pytest
+
+from grid_diff import GridDiff
+
+
+@pytest.fixture
+def grid_diff():
+    return GridDiff(fakeredis.FakeRedis())
+
+
+def test_new_rows_are_added_by_id(grid_diff):
+    transaction = grid_diff.transaction("tab", add=[{"id": "1", "status": "Queued", "name": "my_task_1"}])
+    assert transaction == {"add": [{"id": "1"}]}
+    # the grid has it now
+    assert grid_diff.transaction("tab", add=[{"id": "1", "status": "Queued", "name": "my_task_1"}]) == {}
+
+
+def test_only_changed_fields_are_updated(grid_diff):
+    grid_diff.record("tab", [{"id": "1", "status": "Queued", "name": "my_task_1", "progress": None}])
+    transaction = grid_diff.transaction("tab", update=[{"id": "1", "status": "Running", "name": "my_task_1", "progress": 10}])
+    assert transaction == {"update": [{"id": "1", "status": "Running", "progress": 10}]}
+    assert grid_diff.transaction("tab", update=[{"id": "1", "status": "Running", "progress": 10}]) == {}
+    assert grid_diff.transaction("tab", update=[{"id": "1", "progress": 20}]) == {"update": [{"id": "1", "progress": 20}]}
+
+
+def test_rows_the_grid_hasnt_loaded_arent_updated(grid_diff):
+    assert grid_diff.transaction("tab", update=[{"id": "1", "status": "Running"}]) == {}
+
+
+def test_only_loaded_rows_are_removed(grid_diff):
+    grid_diff.record("tab", [{"id": "1", "status": "Complete"}])
+    assert grid_diff.transaction("tab", remove=["1", "2"]) == {"remove": [{"id": "1"}]}
+    assert grid_diff.transaction("tab", remove=["1"]) == {}
+
+
+def test_rows_added_and_removed_together_are_kept(grid_diff):
+    grid_diff.record("tab", [{"id": "1", "status": "Queued"}])
+    assert grid_diff.transaction("tab", update=[{"id": "1", "status": "Running"}], remove=["1"]) == {
+        "update": [{"id": "1", "status": "Running"}]
+    }
+
+
+def test_sessions_are_independent(grid_diff):
+    grid_diff.record("tab_1", [{"id": "1", "status": "Queued"}])
+    assert grid_diff.transaction("tab_2", update=[{"id": "1", "status": "Running"}]) == {}
+    assert grid_diff.transaction("tab_1", update=[{"id": "1", "status": "Running"}]) == {"update": [{"id": "1", "status": "Running"}]}
+    assert grid_diff.transaction(None, add=[{"id": "2"}]) == {}
+
+
+def test_the_state_expires(grid_diff):
+    grid_diff.record("tab", [{"id": "1", "status": "Queued"}])
+    assert 0 < grid_diff.redis_client.ttl(grid_diff.prefix + "tab") <= grid_diff.ttl
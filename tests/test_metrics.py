@@ -0,0 +1,44 @@
+import fakeredis
+
+from metrics import MetricsRegistry
+
+
+def test_shared_metrics_add_up_the_processes():
+    redis_client = fakeredis.FakeRedis()
+    workers = [MetricsRegistry(), MetricsRegistry()]
+    for registry in workers:
+        registry.redis_client = redis_client
+        registry.observe("callback.check_task_status", 0.02)
+        registry.inc("ticks", 2)
+    workers[0].flush()
+    output = workers[1].render()
+    assert 'celery_monitor_operation_seconds_count{operation="callback.check_task_status"} 2' in output
+    assert 'celery_monitor_operation_seconds_bucket{operation="callback.check_task_status",le="0.025"} 2' in output
+    assert "celery_monitor_ticks_total 4.0" in output
+    assert "pid=" not in output
+    # what has been flushed isn't added again
+    assert workers[0].render() == workers[1].render()
+
+
+def test_local_metrics_have_the_pid():
+    registry = MetricsRegistry()
+    registry.inc("ticks")
+    assert "celery_monitor_ticks_total{pid=" in registry.render()
+
+
+def test_render_falls_back_to_the_local_metrics_when_redis_is_down():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    registry = MetricsRegistry()
+    registry.redis_client = fakeredis.FakeRedis(server=server)
+    registry.inc("ticks")
+    assert "celery_monitor_ticks_total{pid=" in registry.render()
+    # they are flushed once redis is back
+    server.connected = True
+    assert "celery_monitor_ticks_total 1.0" in registry.render()
+
+
+def test_operation_labels_are_escaped():
+    registry = MetricsRegistry()
+    registry.observe('task "a\\b"', 0.01)
+    assert 'operation="task \\"a\\\\b\\""' in registry.render()
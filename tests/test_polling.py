@@ -0,0 +1,33 @@
+from polling import next_backoff, next_check_in
+
+
+def test_backoff_grows_while_nothing_changes():
+    backoff = next_backoff(None, changed=False, min_interval=2, max_interval=60)
+    assert backoff == 2
+    backoffs = []
+    for _ in range(6):
+        backoff = next_backoff(backoff, changed=False, min_interval=2, max_interval=60)
+        backoffs.append(backoff)
+    assert backoffs == [4, 8, 16, 32, 60, 60]
+
+
+def test_backoff_resets_on_changes():
+    assert next_backoff(32, changed=True, min_interval=2) == 2
+
+
+def test_check_in_follows_the_backoff_without_expected_finishes():
+    assert next_check_in(16, [], now=100) == 16
+
+
+def test_check_in_moves_to_the_next_expected_finish():
+    # the result is stored ~slack seconds after the task finishes
+    assert next_check_in(30, [110, 120], now=100, slack=1.0) == 11
+
+
+def test_tasks_running_late_follow_the_backoff():
+    assert next_check_in(30, [90, 98.5], now=100, slack=1.0) == 30
+
+
+def test_check_in_never_goes_below_the_min_interval():
+    assert next_check_in(30, [100.5], now=100, min_interval=2, slack=1.0) == 2
+    assert next_check_in(1, [], now=100, min_interval=2) == 2
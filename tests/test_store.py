@@ -0,0 +1,113 @@
+import pytest
+
+from store import SQLiteTaskStore, TaskStoreWriter, task_changes, text_filter_sql
+
+
+@pytest.fixture
+def task_store(tmp_path):
+    task_store = SQLiteTaskStore(str(tmp_path / "tasks.db"))
+    task_store.upsert_many([
+        {"id": "1", "name": "my_task_1", "kwargs": "{'n_clicks': 1}", "status": "Running"},
+        {"id": "2", "name": "my_task_2", "kwargs": "{'n_clicks': 2}", "status": "Complete"},
+        {"id": "3", "name": "my_task_1", "kwargs": "100%_done", "status": "Queued"},
+        {"id": "4", "name": "other", "status": "Queued"},
+    ])
+    return task_store
+
+
+def query_ids(task_store, filter_model):
+    rows, row_count = task_store.query(filter_model=filter_model, sort_model=[{"colId": "id", "sort": "asc"}])
+    assert row_count == len(rows)
+    return [row["id"] for row in rows]
+
+
+@pytest.mark.parametrize("column_filter, expected", [
+    ({"type": "contains", "filter": "TASK_1"}, ["1", "3"]),
+    ({"type": "notContains", "filter": "task"}, ["4"]),
+    ({"type": "equals", "filter": "MY_TASK_2"}, ["2"]),
+    ({"type": "notEqual", "filter": "my_task_1"}, ["2", "4"]),
+    ({"type": "startsWith", "filter": "my"}, ["1", "2", "3"]),
+    ({"type": "endsWith", "filter": "_2"}, ["2"]),
+    ({"operator": "OR", "conditions": [{"type": "equals", "filter": "other"}, {"type": "endsWith", "filter": "2"}]}, ["2", "4"]),
+    ({"operator": "AND", "conditions": [{"type": "startsWith", "filter": "my"}, {"type": "endsWith", "filter": "1"}]}, ["1", "3"]),
+])
+def test_text_filters(task_store, column_filter, expected):
+    assert query_ids(task_store, {"name": {"filterType": "text", **column_filter}}) == expected
+
+
+def test_text_filter_escapes_like_wildcards(task_store):
+    assert query_ids(task_store, {"kwargs": {"filterType": "text", "type": "contains", "filter": "%_"}}) == ["3"]
+    assert query_ids(task_store, {"kwargs": {"filterType": "text", "type": "blank"}}) == ["4"]
+    assert query_ids(task_store, {"kwargs": {"filterType": "text", "type": "notBlank"}}) == ["1", "2", "3"]
+
+
+def test_text_filter_sql_params():
+    sql, params = text_filter_sql("name", {"type": "startsWith", "filter": "a\\b"})
+    assert sql == "name LIKE ? ESCAPE '\\'"
+    assert params == ["a\\\\b%"]
+
+
+def test_unknown_columns_are_ignored(task_store):
+    assert query_ids(task_store, {"id = id; --": {"type": "equals", "filter": "x"}}) == ["1", "2", "3", "4"]
+
+
+def test_task_changes_new_task():
+    changes = task_changes(None, {"id": "1", "status": "Queued", "name": None})
+    assert changes["status"] == "Queued"
+    assert "name" not in changes
+    assert changes["sent_at"] and changes["updated_at"]
+
+
+def test_task_changes_status_never_goes_back():
+    stored = {"id": "1", "status": "Running", "sent_at": 1}
+    assert task_changes(stored, {"id": "1", "status": "Queued"}) == {}
+    assert task_changes(stored, {"id": "1", "status": "Complete"})["status"] == "Complete"
+
+
+def test_task_changes_final_status_is_kept():
+    stored = {"id": "1", "status": "Complete", "progress": 100, "done_at": 5}
+    assert task_changes(stored, {"id": "1", "status": "Cancelled", "time_end": "12:00:00", "progress": 40}) == {}
+
+
+def test_task_changes_sets_done_at_once():
+    assert task_changes({"id": "1", "status": "Running"}, {"id": "1", "status": "Failed"})["done_at"]
+    assert "done_at" not in task_changes({"id": "1", "status": "Running", "done_at": 5}, {"id": "1", "status": "Failed"})
+
+
+def test_list_args_are_compared_as_stored(task_store):
+    row = {"id": "5", "name": "my_task_1", "args": [], "kwargs": {"n_clicks": 1}, "status": "Running"}
+    assert len(task_store.upsert_many([row])) == 1
+    assert task_store.upsert_many([row]) == []
+    assert task_store.upsert_many([row]) == []
+    assert task_store.get("5")["args"] == "[]"
+
+
+def test_writer_applies_the_rows_in_order(task_store):
+    writer = TaskStoreWriter(task_store)
+    writer.rows.put({"id": "6", "name": "my_task_1", "status": "Queued"})
+    writer.rows.put({"id": "6", "status": "Running"})
+    writer.rows.put({"id": "6", "status": "Complete"})
+    assert writer.flush() == 3
+    assert task_store.get("6")["status"] == "Complete"
+    assert writer.flush() == 0
+
+
+@pytest.mark.parametrize("column_filter, expected", [
+    ({"type": "greaterThan", "filter": 60}, ["9"]),
+    ({"type": "greaterThanOrEqual", "filter": 50}, ["8", "9"]),
+    ({"type": "lessThan", "filter": 50}, ["7"]),
+    ({"type": "lessThanOrEqual", "filter": 50}, ["7", "8"]),
+    ({"type": "equals", "filter": 50}, ["8"]),
+    ({"type": "notEqual", "filter": 50}, ["1", "2", "3", "4", "7", "9"]),
+    ({"type": "inRange", "filter": 10, "filterTo": 80}, ["8", "9"]),
+    ({"type": "blank"}, ["1", "2", "3", "4"]),
+    ({"type": "greaterThan", "filter": None}, ["1", "2", "3", "4", "7", "8", "9"]),
+    ({"operator": "OR", "conditions": [{"type": "lessThan", "filter": 10}, {"type": "greaterThan", "filter": 70}]}, ["7", "9"]),
+])
+def test_number_filters(task_store, column_filter, expected):
+    task_store.upsert_many([
+        {"id": "7", "status": "Running", "progress": 5},
+        {"id": "8", "status": "Running", "progress": 50},
+        {"id": "9", "status": "Running", "progress": 75},
+    ])
+    assert query_ids(task_store, {"progress": {"filterType": "number", **column_filter}}) == expected
@@ -0,0 +1,97 @@
+import uuid
+
+import fakeredis
+import pytest
+from celery import Celery
+
+from submission import SubmissionQueue
+
+
+@pytest.fixture
+def celery_app():
+    celery_app = Celery("tests", broker="memory://")
+    # the memory broker is shared by the whole process: a queue per test
+    celery_app.conf.task_default_queue = str(uuid.uuid4())
+    return celery_app
+
+
+@pytest.fixture
+def submissions(celery_app):
+    return SubmissionQueue(celery_app, fakeredis.FakeRedis(), rate=1, burst=5, max_queued=100)
+
+
+def test_same_submission_of_the_same_user_is_deduplicated(submissions):
+    task_ids, status = submissions.submit("user_1", "my_task_1", {"n_clicks": 1}, count=2)
+    assert status == "submitted" and len(task_ids) == 2
+    assert submissions.submit("user_1", "my_task_1", {"n_clicks": 1}, count=2) == (task_ids, "duplicate")
+    assert submissions.pending_count() == 2
+
+
+def test_other_users_arent_deduplicated(submissions):
+    task_ids, _ = submissions.submit("user_1", "my_task_1", {"n_clicks": 1})
+    other_task_ids, status = submissions.submit("user_2", "my_task_1", {"n_clicks": 1})
+    assert status == "submitted" and other_task_ids != task_ids
+
+
+def test_token_bucket_per_user(submissions):
+    task_ids, status = submissions.submit("user_1", "my_task_1", {"n_clicks": 1}, count=7)
+    assert status == "rate_limited" and len(task_ids) == 5
+    assert submissions.submit("user_1", "my_task_1", {"n_clicks": 2}) == ([], "rate_limited")
+    # the bucket of another user is full
+    assert submissions.submit("user_2", "my_task_1", {"n_clicks": 2}, count=5)[1] == "submitted"
+
+
+def test_rejected_submissions_can_be_sent_again(submissions):
+    submissions.submit("user_1", "my_task_1", {"n_clicks": 1}, count=5)
+    assert submissions.submit("user_1", "my_task_1", {"n_clicks": 2})[1] == "rate_limited"
+    submissions.redis_client.delete(submissions.prefix + "bucket:user_1")
+    assert submissions.submit("user_1", "my_task_1", {"n_clicks": 2})[1] == "submitted"
+
+
+def test_submissions_have_between_1_and_max_count_tasks(submissions):
+    submissions.max_count = 3
+    for count in [0, -1, 4]:
+        with pytest.raises(ValueError):
+            submissions.submit("user_1", "my_task_1", {"n_clicks": count}, count=count)
+    assert submissions.pending_count() == 0
+    assert submissions.submit("user_1", "my_task_1", {"n_clicks": 3}, count=3)[1] == "submitted"
+
+
+def test_dispatch_by_priority_then_submission_order(submissions):
+    normal, _ = submissions.submit("user_1", "my_task_1", {"n_clicks": 1}, count=2)
+    low, _ = submissions.submit("user_1", "my_task_1", {"n_clicks": 2}, priority="low")
+    high, _ = submissions.submit("user_1", "my_task_1", {"n_clicks": 3}, priority="high")
+    assert submissions.dispatch() == high + normal + low
+    assert submissions.pending_count() == 0
+    assert submissions.redis_client.hlen(submissions.prefix + "tasks") == 0
+
+
+def test_dispatch_keeps_the_broker_queue_short(submissions):
+    submissions.max_queued = 3
+    submissions.submit("user_1", "my_task_1", {"n_clicks": 1}, count=5)
+    assert len(submissions.dispatch()) == 3
+    # the memory broker still has them
+    assert submissions.dispatch() == []
+    assert submissions.pending_count() == 2
+
+
+def test_cancelled_tasks_arent_sent(submissions):
+    task_ids, _ = submissions.submit("user_1", "my_task_1", {"n_clicks": 1}, count=3)
+    assert submissions.cancel(task_ids[:1]) == task_ids[:1]
+    assert submissions.dispatch() == task_ids[1:]
+
+
+def test_only_the_unsent_tasks_go_back_to_the_queue(submissions, celery_app, monkeypatch):
+    task_ids, _ = submissions.submit("user_1", "my_task_1", {"n_clicks": 1}, count=3)
+    send_task = celery_app.send_task
+
+    def failing_send_task(*args, task_id=None, **kwargs):
+        if task_id == task_ids[1]:
+            raise ConnectionError("broker down")
+        return send_task(*args, task_id=task_id, **kwargs)
+
+    monkeypatch.setattr(celery_app, "send_task", failing_send_task)
+    with pytest.raises(ConnectionError):
+        submissions.dispatch()
+    monkeypatch.setattr(celery_app, "send_task", send_task)
+    assert submissions.dispatch() == task_ids[1:]
@@ -0,0 +1,116 @@
+import math
+import threading
+import time
+from collections import defaultdict, deque
+
+import metrics
+
+
+# nearest-rank percentile, None if there are no values
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(q / 100 * len(values)) - 1, 0)]
+
+
+class ThroughputStats:
+    # rolling aggregates by worker and by task name, fed by the TaskEventTracker (add_listener(stats.observe)):
+    # tasks/sec, queue wait (sent -> started) and runtime (started -> done) over the last `window` seconds
+    # every series is a ring buffer, so observing an event is O(1) whatever the event rate:
+    # - completed tasks: [second, count] for every second of the window
+    # - wait and runtime: the last `max_samples` (timestamp, value); percentiles are computed when the panel asks for them
+    # every gunicorn worker consumes all the events, so all of them have the same stats
+
+    def __init__(self, window=300, max_samples=1000):
+        self.window = window
+        self.max_samples = max_samples
+        # (scope, cluster, key) -> {"wait": deque, "runtime": deque}
+        self._series = defaultdict(lambda: defaultdict(lambda: deque(maxlen=self.max_samples)))
+        # (scope, cluster, key) -> deque of [second, count]
+        self._completed = defaultdict(lambda: deque(maxlen=int(self.window) + 1))
+        self._lock = threading.Lock()
+
+    def observe(self, task_info):
+        event = task_info.get("last_event")
+        keys = [
+            (scope, task_info.get("cluster"), task_info.get(field))
+            for scope, field in [("worker", "hostname"), ("task", "name")] if task_info.get(field)
+        ]
+        samples = []
+        done_at = None
+        if event == "task-started" and task_info.get("sent_at") and task_info.get("started_at"):
+            samples.append(("wait", task_info["started_at"], task_info["started_at"] - task_info["sent_at"]))
+        elif event in ["task-succeeded", "task-failed"] and task_info.get("done_at"):
+            done_at = task_info["done_at"]
+            if task_info.get("started_at"):
+                samples.append(("runtime", done_at, done_at - task_info["started_at"]))
+        if not (samples or done_at):
+            return
+        with self._lock:
+            for key in keys:
+                for series, timestamp, value in samples:
+                    self._series[key][series].append((timestamp, value))
+                if done_at:
+                    completed = self._completed[key]
+                    if completed and completed[-1][0] == int(done_at):
+                        completed[-1][1] += 1
+                    else:
+                        completed.append([int(done_at), 1])
+
+    # median runtime of the last tasks with this name (not only the ones of the window), None if there aren't any
+    def expected_runtime(self, cluster, name):
+        with self._lock:
+            series = self._series.get(("task", cluster, name))
+            runtimes = [v for _, v in series["runtime"]] if series and "runtime" in series else []
+        return percentile(runtimes, 50)
+
+    # one row per worker and per task name with the aggregates of the last `window` seconds
+    @metrics.timed("throughput.rows")
+    def rows(self):
+        since = time.time() - self.window
+        with self._lock:
+            series = {key: {name: list(samples) for name, samples in s.items()} for key, s in self._series.items()}
+            completed = {key: [list(c) for c in counts] for key, counts in self._completed.items()}
+        rows = []
+        for scope, cluster, key in sorted(set(series) | set(completed), key=lambda k: [str(v) for v in k]):
+            s = series.get((scope, cluster, key), {})
+            done = sum(count for second, count in completed.get((scope, cluster, key), []) if second >= since)
+            wait = [v for t, v in s.get("wait", []) if t >= since]
+            runtime = [v for t, v in s.get("runtime", []) if t >= since]
+            if not (done or wait or runtime):
+                continue
+            rows.append({
+                "scope": scope,
+                "cluster": cluster,
+                "key": key,
+                "completed": done,
+                "tasks_per_sec": round(done / self.window, 3),
+                "wait_p50": percentile(wait, 50),
+                "wait_p95": percentile(wait, 95),
+                "runtime_p50": percentile(runtime, 50),
+                "runtime_p95": percentile(runtime, 95),
+            })
+        return rows
+
+
+# {queue name: messages waiting in the broker} for the queues of the celery app
+# (with redis it's the LLEN of the list of every priority of the queue)
+# it uses the default channel of the connection: with redis a new channel is a new TCP connection
+@metrics.timed("broker.queue_depths")
+def queue_depths(celery_app, connection=None):
+    depths = {}
+    with celery_app.connection_or_acquire(connection) as connection:
+        channel = connection.default_channel
+        for queue in celery_app.amqp.queues:
+            try:
+                depths[queue] = channel.queue_declare(queue=queue, passive=True).message_count
+            # the queue doesn't exist yet (redis deletes empty lists)
+            except connection.channel_errors:
+                depths[queue] = 0
+                # amqp closes the channel after an error (redis doesn't): the rest go to a new one
+                if not getattr(channel, "is_open", True):
+                    channel = connection.channel()
+        if channel is not connection.default_channel:
+            channel.close()
+    return depths
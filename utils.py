@@ -1,6 +1,11 @@
 from dash import dcc, html
 import dash_bootstrap_components as dbc
 import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+import metrics
+
+# tasks with these statuses won't change anymore, so they are skipped by the checks
+FINAL_STATUSES = ["Cancelled", "Complete", "Failed"]
 
 app_description_text = """
 The purpose of this app is to allow the user to interact with celery tasks
@@ -92,8 +97,8 @@ app_description = html.Div(
 task_description = dcc.Markdown("""
 You can:
 - Start two types of tasks and see how their status changes in the table. The celery process has two workers, so only two tasks (max) should show the 'Running' status at the same time.
-- Select one task and cancel it by clicking on the 'Cancel' button.
-- Get an overview of the tasks Celery is handling at any moment by clicking the 'Check Celery status and update table' button (the update can take up to 10 seconds and it will appear at the bottom of the window - scroll down if you don't see it). The table will get updated automatically every minute, and the 'Cancelled' status will appear immediately, but the 'Complete' and 'Running' status will only be updated by the interval or the button click.
+- Send several tasks at once (number of tasks per click) and select one or more tasks to cancel them by clicking on the 'Cancel' button.
+- Get an overview of the tasks Celery is handling at any moment by clicking the 'Check Celery status and update table' button (the update can take a couple of seconds and it will appear at the bottom of the window - scroll down if you don't see it). The table gets updated as soon as the tasks change (if the browser can't keep the connection for updates open, it will be updated every minute and with the button click instead).
 """)
 
 def celery_status_summary(celery_status_text):
@@ -110,22 +115,59 @@ def celery_status_summary(celery_status_text):
     )
 )
 
-def update_row_value(row_dict: dict, updated_values: dict):
-    updatedRow = row_dict.copy()
-    for k, v in updated_values.items():
-        updatedRow[k] = v
-    return updatedRow
+# tasks: list of (task_name, task_kwargs)
+# each thread has its own reply queue for the inspector broadcasts (kombu's Mailbox.oid includes the thread id)
+# so the broadcasts sent from different threads don't steal each other's replies
+# (every clusters.Cluster has its own, so a cluster that is down doesn't take the threads of the rest)
+inspector_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="celery-inspector")
+
+# calls: {key: function with no arguments}
+# runs all the calls at the same time and waits for them for `deadline` seconds in total
+# returns {key: result}; the result is None for calls that failed or didn't finish on time
+# (same as an inspector broadcast with no replies)
+def inspect_concurrently(calls: dict, deadline: float, executor=inspector_executor):
+    futures = {k: executor.submit(f) for k, f in calls.items()}
+    done, _ = wait(futures.values(), timeout=deadline)
+    results = {}
+    for k, future in futures.items():
+        results[k] = future.result() if future in done and not future.exception() else None
+    return results
+
+# the inspector broadcasts wait `timeout` seconds for replies; the extra second is for the connection
+def inspector_deadline(celery_inspector):
+    return (celery_inspector.timeout or 1.0) + 1.0
+
+# replies of the inspector broadcasts, by hostname
+# the three broadcasts are sent in parallel, so this takes ~1 broadcast timeout instead of 3
+def get_inspector_snapshot(celery_inspector, executor=inspector_executor):
+    return inspect_concurrently(
+        {
+            "active":metrics.timed("inspector.active")(celery_inspector.active),
+            "reserved":metrics.timed("inspector.reserved")(celery_inspector.reserved),
+            "revoked":metrics.timed("inspector.revoked")(celery_inspector.revoked)
+        },
+        inspector_deadline(celery_inspector),
+        executor=executor,
+    )
+
+# cache is a cache.SharedCache: all the workers and sessions share the same snapshot
+# instead of sending the inspector broadcasts on every call
+def get_cached_inspector_snapshot(celery_inspector, cache=None, executor=inspector_executor):
+    if cache is None:
+        return get_inspector_snapshot(celery_inspector, executor)
+    with metrics.timer("cache.inspector_snapshot"):
+        return cache.get("inspector_snapshot", lambda: get_inspector_snapshot(celery_inspector, executor))
+
+def get_celery_status(celery_inspector, only_ids=False, cache=None, executor=inspector_executor):
+    all_tasks = get_cached_inspector_snapshot(celery_inspector, cache, executor)
+    return parse_inspector_snapshot(all_tasks, only_ids)
 
-def get_celery_status(celery_inspector, only_ids=False):
+# rows for the grid from the output of get_inspector_snapshot
+def parse_inspector_snapshot(all_tasks, only_ids=False):
     celery_data = []
-    active_tasks = celery_inspector.active()
-    reserved_tasks = celery_inspector.reserved()
-    revoked_tasks = celery_inspector.revoked()
-    all_tasks = {
-        "active":active_tasks,
-        "reserved":reserved_tasks,
-        "revoked":revoked_tasks
-    }
+    active_tasks = all_tasks["active"]
+    reserved_tasks = all_tasks["reserved"]
+    revoked_tasks = all_tasks["revoked"]
     active_tasks_keys = list(active_tasks.keys()) if active_tasks else []
     reserved_tasks_keys =  list(reserved_tasks.keys()) if reserved_tasks else []
     revoked_tasks_keys =  list(revoked_tasks.keys()) if revoked_tasks else []